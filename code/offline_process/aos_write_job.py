@@ -5,7 +5,6 @@ from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth, he
 import boto3
 import random
 import json
-from awsglue.utils import getResolvedOptions
 import sys
 import hashlib
 import datetime
@@ -17,8 +16,24 @@ import urllib.parse
 import numpy as np
 from urllib.parse import unquote
 from datetime import datetime
+import codecs
+import gzip
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from job_args import getResolvedOptions, get_optional_args
+from embedders import get_embedder, embed_in_batches
+from glossary_snapshot import build_snapshot, get_snapshot_key, get_latest_snapshot_key, SNAPSHOT_DOC_TYPES
 
 args = getResolvedOptions(sys.argv, ['bucket', 'object_key','AOS_ENDPOINT','REGION','AOS_INDEX'])
+optional_args = get_optional_args(sys.argv, {'streaming': 'false', 'stream_chunk_kb': '1024',
+                                            'incremental': 'false', 'manifest_prefix': 'ingest_manifest',
+                                            'bulk_threads': '4', 'bulk_chunk_size': '500', 'bulk_chunk_mb': '10', 'bulk_max_retries': '3', 'max_files_in_flight': '2',
+                                            'embedding_model': '', 'embedding_dimension': '1024', 'embedding_batch_size': '96',
+                                            'rebuild': 'false', 'keep_previous_indices': '1',
+                                            'glossary_snapshot': 'false', 'glossary_snapshot_prefix': 'glossary_snapshot',
+                                            'group_terms': '0'})
 s3 = boto3.resource('s3')
 bucket = args['bucket']
 object_key = args['object_key']
@@ -26,46 +41,249 @@ object_key = args['object_key']
 AOS_ENDPOINT = args['AOS_ENDPOINT']
 AOS_INDEX = args['AOS_INDEX']
 REGION = args['REGION']
+# parse the S3 body incrementally instead of loading the whole file, .jsonl files are always streamed
+STREAMING_INGEST = optional_args['streaming'].lower() == 'true'
+STREAM_CHUNK_BYTES = int(optional_args['stream_chunk_kb']) * 1024
+# content addressed ids + a per-file manifest of ingested ids, only changed terms are written and removed terms deleted
+INCREMENTAL_INGEST = optional_args['incremental'].lower() == 'true'
+MANIFEST_PREFIX = optional_args['manifest_prefix'].strip('/')
+# bulk requests in flight per file, and documents / bytes per bulk request
+BULK_THREADS = max(1, int(optional_args['bulk_threads']))
+BULK_CHUNK_SIZE = int(optional_args['bulk_chunk_size'])
+BULK_CHUNK_BYTES = int(optional_args['bulk_chunk_mb']) * 1024 * 1024
+BULK_MAX_RETRIES = int(optional_args['bulk_max_retries'])
+# number of S3 files ingested at the same time
+MAX_FILES_IN_FLIGHT = max(1, int(optional_args['max_files_in_flight']))
+# load all object_keys into a new versioned index and swap the AOS_INDEX alias to it afterwards,
+# the keys of one rebuild must be passed to a single run
+REBUILD_INDEX = optional_args['rebuild'].lower() == 'true'
+# versioned indices kept besides the live one after a rebuild, for a rollback by moving the alias back.
+# the indices that served behind the alias are tracked by the <alias>-previous alias
+KEEP_PREVIOUS_INDICES = int(optional_args['keep_previous_indices'])
+# after an ingest without failures, the terminology of the whole index is written to S3 as a snapshot for the translate job's snapshot engine
+PUBLISH_GLOSSARY_SNAPSHOT = optional_args['glossary_snapshot'].lower() == 'true'
+GLOSSARY_SNAPSHOT_PREFIX = optional_args['glossary_snapshot_prefix'].strip('/')
+# crosslingual terms are written as one document per entity_type and group_terms terms, in its multi-valued `terms` field,
+# instead of one document per term. 0 keeps one document per term, the translate job needs --grouped_terms true to read groups
+GROUP_TERMS = int(optional_args['group_terms'])
 
 bedrock = boto3.client(service_name='bedrock-runtime',
                        region_name=REGION)
 
+# fills the knn `embedding` field of the index, disabled if empty
+embedder = get_embedder(optional_args['embedding_model'], bedrock, int(optional_args['embedding_dimension']))
+EMBEDDING_BATCH_SIZE = int(optional_args['embedding_batch_size'])
+
 publish_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-def iterate_items(file_content, object_key):
-    json_obj = json.loads(file_content)
-    file_name = object_key.split('/')[-1].replace('.json', '')
+# AOS_INDEX, or the new versioned index while rebuilding
+write_index = AOS_INDEX
+
+def get_doc_title(object_key):
+    file_name = object_key.split('/')[-1]
+    for suffix in ['.jsonl', '.json']:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+def infer_doc_type(item):
+    # used when the items come before the "type" key, or a jsonl line has no header
+    if "mapping" in item:
+        return "multilingual_terminology"
+    elif "terms" in item:
+        return "crosslingual_terminology"
+    return None
 
-    if json_obj["type"] == "multilingual_terminology":
-        arr = json_obj["data"]
-        doc_type = json_obj["type"]
-        author = json_obj.get("author","")
-        print(f"doc_type:{doc_type}, author:{author}")
+def build_doc_id(document):
+    if INCREMENTAL_INGEST:
+        # publish_date and idx are left out so that an unchanged term keeps its id across re-ingests
+        content = document.get("terms", document["content"])
+        if document["doc_type"] == "multilingual_terminology":
+            content = json.loads(content)
+        stable_content = [document["doc_title"], document["doc_type"], document["doc_category"], content]
+        return hashlib.md5(json.dumps(stable_content, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+    return hashlib.md5(str(document).encode('utf-8')).hexdigest()
 
-        for idx, item in enumerate(arr):
-            content = json.dumps(item["mapping"])
-            doc_category = item["entity_type"]
+def iterate_item_actions(doc_type, author, idx, item, file_name, object_key):
+    if doc_type == "multilingual_terminology":
+        content = json.dumps(item["mapping"])
+        doc_category = item["entity_type"]
+        try:
+            document = { "publish_date": publish_date, "doc" : '', "idx": idx, "doc_type" : doc_type, "content" : content, "doc_title": file_name, "doc_key": object_key, "doc_author": author, "doc_category": doc_category}
+            # every language in its own analyzed field, so the translate job can match term_<src_lang> and filter on langs
+            for lang, term in item["mapping"].items():
+                if term:
+                    document[f"term_{lang}"] = term
+            document["langs"] = [ lang for lang, term in item["mapping"].items() if term ]
+            yield {"_index": write_index, "_source": document, "_id": build_doc_id(document)}
+        except Exception as e:
+            print(f"failed to process, {str(e)}")
+
+    elif doc_type == "crosslingual_terminology":
+        doc_category = item["entity_type"]
+
+        for term in item["terms"]:
             try:
-                document = { "publish_date": publish_date, "doc" : '', "idx": idx, "doc_type" : doc_type, "content" : content, "doc_title": file_name, "doc_author": author, "doc_category": doc_category}
-                yield {"_index": AOS_INDEX, "_source": document, "_id": hashlib.md5(str(document).encode('utf-8')).hexdigest()}
+                document = { "publish_date": publish_date, "doc" : '', "idx": idx, "doc_type" : doc_type, "content" : term, "doc_title": file_name, "doc_key": object_key, "doc_author": author, "doc_category": doc_category}
+                yield {"_index": write_index, "_source": document, "_id": build_doc_id(document)}
             except Exception as e:
                 print(f"failed to process, {str(e)}")
 
-    elif json_obj["type"] == "crosslingual_terminology":
-        arr = json_obj["data"]
-        doc_type = json_obj["type"]
-        author = json_obj.get("author", "")
-        print(f"doc_type:{doc_type}, author:{author}")
+def group_term_actions(actions, group_size):
+    # crosslingual documents are buffered per entity_type and written as one document per group_size terms,
+    # with incremental ingest an added or removed term changes the ids of the following groups of its entity_type
+    groups = {}
+
+    def build_group_action(documents):
+        document = dict(documents[0], content='', terms=[ document["content"] for document in documents ])
+        return {"_index": write_index, "_source": document, "_id": build_doc_id(document)}
+
+    for action in actions:
+        document = action["_source"]
+        if document["doc_type"] != "crosslingual_terminology":
+            yield action
+            continue
+        group = groups.setdefault(document["doc_category"], [])
+        group.append(document)
+        if len(group) >= group_size:
+            yield build_group_action(group)
+            groups[document["doc_category"]] = []
+    for group in groups.values():
+        if group:
+            yield build_group_action(group)
+
+def iterate_items(file_content, object_key):
+    json_obj = json.loads(file_content)
+    file_name = get_doc_title(object_key)
+
+    arr = json_obj["data"]
+    doc_type = json_obj["type"]
+    author = json_obj.get("author","")
+    print(f"doc_type:{doc_type}, author:{author}")
+
+    for idx, item in enumerate(arr):
+        yield from iterate_item_actions(doc_type, author, idx, item, file_name, object_key)
+
+class StreamingJsonReader():
+    # minimal pull parser over text chunks, only the current value and one chunk are kept in memory
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # next non-whitespace character, None at the end of the stream
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, ch):
+        found = self.peek()
+        if found != ch:
+            raise ValueError(f"invalid json stream, expected '{ch}' but found '{found}'")
+        self.pos += 1
 
-        for idx, item in enumerate(arr):
-            doc_category = item["entity_type"]
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a value that ends exactly at the buffer end may be truncated, e.g. a number
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+def iterate_json_terminology_stream(chunks):
+    # yields (doc_type, author, item) for every element of the "data" array
+    reader = StreamingJsonReader(chunks)
+    header = {}
+    reader.expect('{')
+    while reader.peek() != '}':
+        key = reader.read_value()
+        reader.expect(':')
+        if key == 'data':
+            reader.expect('[')
+            while reader.peek() != ']':
+                item = reader.read_value()
+                yield header.get('type') or infer_doc_type(item), header.get('author', ''), item
+                if reader.peek() == ',':
+                    reader.expect(',')
+            reader.expect(']')
+        else:
+            header[key] = reader.read_value()
+        if reader.peek() == ',':
+            reader.expect(',')
+    reader.expect('}')
+
+def iterate_jsonl_terminology_stream(lines):
+    # {"type": "crosslingual_terminology", "author": ""}    optional header line
+    # {"terms": ["SageMaker", "EC2"], "entity_type": "Service"}
+    # {"mapping": {"CN": "香奈儿", "EN": "CHANEL"}, "entity_type": "Brand"}
+    header = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        obj = json.loads(line)
+        doc_type = infer_doc_type(obj)
+        if doc_type is None:
+            header = obj
+            continue
+        yield doc_type, header.get('author', ''), obj
 
-            for term in item["terms"]:
-                try:
-                    document = { "publish_date": publish_date, "doc" : '', "idx": idx, "doc_type" : doc_type, "content" : term, "doc_title": file_name, "doc_author": author, "doc_category": doc_category}
-                    yield {"_index": AOS_INDEX, "_source": document, "_id": hashlib.md5(str(document).encode('utf-8')).hexdigest()}
-                except Exception as e:
-                    print(f"failed to process, {str(e)}")
+def iterate_s3_text_chunks(bucket, object_key, chunk_size):
+    body = s3.Object(bucket, object_key).get()['Body']
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    for chunk in body.iter_chunks(chunk_size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+def iterate_text_lines(chunks):
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+def iterate_items_streaming(bucket, object_key):
+    file_name = get_doc_title(object_key)
+    chunks = iterate_s3_text_chunks(bucket, object_key, STREAM_CHUNK_BYTES)
+    if object_key.endswith('.jsonl'):
+        item_stream = iterate_jsonl_terminology_stream(iterate_text_lines(chunks))
+    else:
+        item_stream = iterate_json_terminology_stream(chunks)
+
+    printed_header = False
+    for idx, (doc_type, author, item) in enumerate(item_stream):
+        if not printed_header:
+            print(f"doc_type:{doc_type}, author:{author}")
+            printed_header = True
+        try:
+            yield from iterate_item_actions(doc_type, author, idx, item, file_name, object_key)
+        except Exception as e:
+            print(f"failed to process, {str(e)}")
 
 def load_content_json_from_s3(bucket, object_key):
     if object_key.endswith('.json'):
@@ -76,27 +294,190 @@ def load_content_json_from_s3(bucket, object_key):
         
     return file_content
 
-def WriteVecIndexToAOS(bucket, object_key):
-    credentials = boto3.Session().get_credentials()
-    auth = AWSV4SignerAuth(credentials, REGION)
+def get_embedding_text(document):
+    if document["doc_type"] == "multilingual_terminology":
+        return " / ".join(str(term) for term in json.loads(document["content"]).values())
+    return document["content"]
+
+def embed_actions(actions):
+    # embeds the documents in batches on their way to the bulk requests
+    def flush(batch):
+        embeddings = embed_in_batches(embedder, [ get_embedding_text(action["_source"]) for action in batch ], EMBEDDING_BATCH_SIZE)
+        for action, embedding in zip(batch, embeddings):
+            action["_source"]["embedding"] = embedding
+        return batch
+
+    batch = []
+    for action in actions:
+        # one vector can not stand for all terms of a grouped document, those are only found by bm25
+        if action.get("_op_type", "index") == "delete" or "terms" in action["_source"]:
+            yield action
+            continue
+        batch.append(action)
+        if len(batch) >= EMBEDDING_BATCH_SIZE:
+            yield from flush(batch)
+            batch = []
+    if batch:
+        yield from flush(batch)
+
+aos_client = None
+aos_client_lock = threading.Lock()
+
+def get_aos_client():
+    # one pooled client shared by every file and bulk thread of the job
+    global aos_client
+    with aos_client_lock:
+        if aos_client is None:
+            credentials = boto3.Session().get_credentials()
+            auth = AWSV4SignerAuth(credentials, REGION)
+            aos_client = OpenSearch(
+                hosts = [{'host': AOS_ENDPOINT, 'port': 443}],
+                http_auth = auth,
+                use_ssl = True,
+                verify_certs = True,
+                connection_class = RequestsHttpConnection,
+                timeout = 60, # 默认超时时间是10 秒，
+                max_retries=5, # 重试次数
+                retry_on_timeout=True,
+                pool_maxsize=max(10, BULK_THREADS * MAX_FILES_IN_FLIGHT)
+            )
+    return aos_client
+
+def get_item_results(failed_items):
+    # parallel_bulk reports {op_type: result} per failed item
+    return [ next(iter(item.values())) for item in failed_items ]
+
+RETRYABLE_BULK_STATUS = [429, 502, 503, 504]
+
+def bulk_ingest(client, actions, object_key):
+    # parallel_bulk yields one result per action in input order, the in flight actions are kept
+    # in a queue to retry the throttled ones, returns (success_count, failed_items) like helpers.bulk
+    pending_actions = deque()
+
+    def track(actions):
+        for action in actions:
+            pending_actions.append(action)
+            yield action
+
+    start_time = time.time()
+    success_count = 0
+    failed_items = []
+    retry_actions = []
+    for ok, info in helpers.parallel_bulk(client, track(actions), thread_count=BULK_THREADS, chunk_size=BULK_CHUNK_SIZE,
+                                          max_chunk_bytes=BULK_CHUNK_BYTES, raise_on_error=False, raise_on_exception=False):
+        action = pending_actions.popleft()
+        if ok:
+            success_count += 1
+        elif get_item_results([info])[0].get('status') in RETRYABLE_BULK_STATUS:
+            retry_actions.append(action)
+        else:
+            failed_items.append(info)
+
+    retry_count = 0
+    for attempt in range(BULK_MAX_RETRIES):
+        if not retry_actions:
+            break
+        retry_count += len(retry_actions)
+        time.sleep(min(0.2 * 2 ** attempt, 10))
+        pending_actions.clear()
+        failed_actions = []
+        for ok, info in helpers.streaming_bulk(client, track(retry_actions), chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_CHUNK_BYTES,
+                                               raise_on_error=False, raise_on_exception=False):
+            action = pending_actions.popleft()
+            if ok:
+                success_count += 1
+            elif get_item_results([info])[0].get('status') in RETRYABLE_BULK_STATUS and attempt < BULK_MAX_RETRIES - 1:
+                failed_actions.append(action)
+            else:
+                failed_items.append(info)
+        retry_actions = failed_actions
 
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"bulk ingest of {object_key}: {success_count} docs in {elapsed:.1f}s ({success_count / elapsed:.0f} docs/sec), failed {len(failed_items)}, retried {retry_count}")
+    for item in failed_items[:10]:
+        print(f"failed item: {item}")
+    return success_count, failed_items
+
+def get_manifest_key(object_key):
+    return f"{MANIFEST_PREFIX}/{object_key}.manifest.gz"
+
+def load_ingest_manifest(bucket, object_key):
+    # ids written by the last successful ingest of object_key, None if it was never ingested incrementally
     try:
-        file_content = load_content_json_from_s3(bucket, object_key)
-
-        client = OpenSearch(
-            hosts = [{'host': AOS_ENDPOINT, 'port': 443}],
-            http_auth = auth,
-            use_ssl = True,
-            verify_certs = True,
-            connection_class = RequestsHttpConnection,
-            timeout = 60, # 默认超时时间是10 秒，
-            max_retries=5, # 重试次数
-            retry_on_timeout=True
-        )
-
-        gen_aos_record_func = iterate_items(file_content, object_key)
-        
-        response = helpers.bulk(client, gen_aos_record_func, max_retries=3, initial_backoff=200, max_backoff=801, max_chunk_bytes=10 * 1024 * 1024)#, chunk_size=10000, request_timeout=60000) 
+        body = s3.Object(bucket, get_manifest_key(object_key)).get()['Body'].read()
+    except s3.meta.client.exceptions.NoSuchKey:
+        return None
+    return set(gzip.decompress(body).decode('utf-8').split())
+
+def save_ingest_manifest(bucket, object_key, doc_ids):
+    body = gzip.compress("\n".join(sorted(doc_ids)).encode('utf-8'))
+    s3.Object(bucket, get_manifest_key(object_key)).put(Body=body)
+
+def filter_changed_actions(actions, previous_ids, current_ids, stats):
+    for action in actions:
+        doc_id = action["_id"]
+        if doc_id in current_ids:
+            continue
+        current_ids.add(doc_id)
+        if doc_id in previous_ids:
+            stats['unchanged'] += 1
+            continue
+        yield action
+
+# (object_key, doc_ids) of a rebuild, saved only once the alias points to the new index
+pending_manifests = []
+
+def write_incremental(client, bucket, object_key, actions):
+    # a rebuild starts from an empty index, every document is written
+    previous_ids = set() if REBUILD_INDEX else load_ingest_manifest(bucket, object_key)
+    if previous_ids is None:
+        # documents of the first full ingest have non-stable ids, drop them before switching to incremental mode.
+        # doc_title is only the file name, files of the same name under other prefixes are matched by the full key in doc_key,
+        # documents written before doc_key existed are not matched and stay until a --rebuild
+        print(f"no ingest manifest for {object_key}, delete existing documents of doc_key {object_key}")
+        client.delete_by_query(index=write_index, body={"query": {"term": {"doc_key": object_key}}}, conflicts="proceed")
+        previous_ids = set()
+
+    current_ids = set()
+    stats = {'unchanged': 0}
+    changed_actions = filter_changed_actions(actions, previous_ids, current_ids, stats)
+    if embedder:
+        changed_actions = embed_actions(changed_actions)
+    response = bulk_ingest(client, changed_actions, object_key)
+
+    removed_ids = previous_ids - current_ids
+    delete_actions = ({"_op_type": "delete", "_index": write_index, "_id": doc_id} for doc_id in removed_ids)
+    delete_response = bulk_ingest(client, delete_actions, f"{object_key} (deletes)")
+
+    # failed writes are left out of the manifest so the next run writes them again,
+    # failed deletes are kept so the next run deletes them again. a document that is already gone is not an error
+    failed_write_ids = { item.get('_id') for item in get_item_results(response[1]) }
+    failed_delete_ids = { item.get('_id') for item in get_item_results(delete_response[1]) if item.get('status') != 404 }
+    if REBUILD_INDEX:
+        pending_manifests.append((object_key, current_ids - failed_write_ids))
+    else:
+        save_ingest_manifest(bucket, object_key, (current_ids - failed_write_ids) | failed_delete_ids)
+    print(f"incremental ingest of {object_key}: written {response[0]}, unchanged {stats['unchanged']}, deleted {len(removed_ids)}")
+    return response
+
+def WriteVecIndexToAOS(bucket, object_key):
+    try:
+        client = get_aos_client()
+
+        if STREAMING_INGEST or object_key.endswith('.jsonl'):
+            gen_aos_record_func = iterate_items_streaming(bucket, object_key)
+        else:
+            file_content = load_content_json_from_s3(bucket, object_key)
+            gen_aos_record_func = iterate_items(file_content, object_key)
+        if GROUP_TERMS > 0:
+            gen_aos_record_func = group_term_actions(gen_aos_record_func, GROUP_TERMS)
+
+        if INCREMENTAL_INGEST:
+            return write_incremental(client, bucket, object_key, gen_aos_record_func)
+
+        if embedder:
+            gen_aos_record_func = embed_actions(gen_aos_record_func)
+        response = bulk_ingest(client, gen_aos_record_func, object_key)
         return response
     except Exception as e:
         print(f"There was an error when ingest:{object_key} to aos cluster, Exception: {str(e)}")
@@ -107,18 +488,141 @@ def process_s3_uploaded_file(bucket, object_key):
     #if want to use different aos index, the object_key format should be: ai-content/company/username/filename
 
     response = WriteVecIndexToAOS(bucket, object_key)
-    print("response:")
-    print(response)
-    print("ingest {} chunk to AOS".format(response[0]))
+    if response is None:
+        print(f"failed to ingest {object_key}")
+        return None
+    print("ingest {} chunk to AOS, {} failed".format(response[0], len(response[1])))
+    return response
+
 
+# settings that describe an existing index and cannot be given to a new one
+READ_ONLY_INDEX_SETTINGS = ['uuid', 'version', 'creation_date', 'provided_name', 'resize', 'blocks', 'routing', 'verified_before_close']
+
+def get_alias_indices(client, alias):
+    if not client.indices.exists_alias(name=alias):
+        return []
+    return sorted(client.indices.get_alias(name=alias).keys())
+
+def create_rebuild_index(client, alias):
+    # the new index copies settings and mappings of the live one (created by deploy/setup_knowledgebase.sh),
+    # without refresh and replicas while loading. returns (new index, settings to restore after the load)
+    live_indices = get_alias_indices(client, alias) or ([alias] if client.indices.exists(index=alias) else [])
+    if not live_indices:
+        raise RuntimeError(f"neither an alias nor an index {alias} exists, create it with deploy/setup_knowledgebase.sh first")
+
+    live_index = client.indices.get(index=live_indices[0])[live_indices[0]]
+    index_settings = { key: value for key, value in live_index['settings']['index'].items() if key not in READ_ONLY_INDEX_SETTINGS }
+    restore_settings = {"index": {"refresh_interval": index_settings.get('refresh_interval'),
+                                  "number_of_replicas": index_settings.get('number_of_replicas', '1')}}
+    index_settings.update({"refresh_interval": "-1", "number_of_replicas": "0"})
+
+    new_index = f"{alias}-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    client.indices.create(index=new_index, body={"settings": {"index": index_settings}, "mappings": live_index['mappings']})
+    print(f"rebuilding {alias} into {new_index}, copied from {live_indices[0]}")
+    return new_index, restore_settings
+
+def drop_rebuild_index(client, new_index):
+    # a rebuild that does not get to the swap leaves no index behind, the alias still points to the complete old one
+    try:
+        client.indices.delete(index=new_index)
+        print(f"deleted unswapped index {new_index}")
+    except Exception as e:
+        print(f"failed to delete unswapped index {new_index}, Exception: {str(e)}")
+
+def finish_rebuild(client, bucket, alias, new_index, restore_settings):
+    # restore the settings, make the index searchable and compact, then move the alias in one atomic request
+    try:
+        client.indices.put_settings(index=new_index, body=restore_settings)
+        client.indices.refresh(index=new_index)
+        client.indices.forcemerge(index=new_index, max_num_segments=1, request_timeout=3600)
+        # 408 if the index is not green within the timeout, e.g. yellow on a single node domain without room for replicas
+        health = client.cluster.health(index=new_index, wait_for_status='green', timeout='10m', request_timeout=700, ignore=408)
+        if health.get('status') != 'green':
+            print(f"{new_index} is {health.get('status')} after waiting for its replicas, swapping anyway")
+        old_indices = get_alias_indices(client, alias)
+    except Exception:
+        drop_rebuild_index(client, new_index)
+        raise
+
+    previous_alias = f"{alias}-previous"
+    actions = [ {"remove": {"index": index, "alias": alias}} for index in old_indices ]
+    actions += [ {"add": {"index": index, "alias": previous_alias}} for index in old_indices ]
+    if not old_indices and client.indices.exists(index=alias):
+        # the first rebuild replaces the plain index of the old setup by the alias
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": new_index, "alias": alias}})
+    client.indices.update_aliases(body={"actions": actions})
+    print(f"alias {alias} moved from {old_indices or [alias]} to {new_index}")
+
+    # the manifests describe the old index, the ones of files that were not reloaded would make an incremental run
+    # skip documents the new index does not have
+    s3.Bucket(bucket).objects.filter(Prefix=f"{MANIFEST_PREFIX}/").delete()
+    for s3_key, doc_ids in pending_manifests:
+        save_ingest_manifest(bucket, s3_key, doc_ids)
+
+    # only indices that served behind the alias are kept for a rollback, the newest ones
+    previous_indices = get_alias_indices(client, previous_alias)
+    for index in previous_indices[:max(0, len(previous_indices) - KEEP_PREVIOUS_INDICES)]:
+        client.indices.delete(index=index)
+        print(f"deleted previous index {index}")
 
 ##如果是从chatbot上传，则是ai-content/username/filename
 def get_filename_from_obj_key(object_key):
     paths = object_key.split('/')
     return paths[1] if len(paths) > 2 else 's3_upload'
 
-for s3_key in object_key.split(','):
+def normalize_s3_key(s3_key):
     s3_key = urllib.parse.unquote(s3_key) ##In case Chinese filename
     s3_key = s3_key.replace('+',' ') ##replace the '+' with space. ps:if the original file name contains space, then s3 notification will replace it with '+'.
-    print("processing {}".format(s3_key))
-    process_s3_uploaded_file(bucket, s3_key)
\ No newline at end of file
+    return s3_key
+
+def ingest_files(bucket, s3_keys):
+    global write_index
+    if REBUILD_INDEX:
+        write_index, restore_settings = create_rebuild_index(get_aos_client(), AOS_INDEX)
+    with ThreadPoolExecutor(max_workers=MAX_FILES_IN_FLIGHT) as executor:
+        responses = list(executor.map(lambda s3_key: process_s3_uploaded_file(bucket, s3_key), s3_keys))
+
+    if REBUILD_INDEX:
+        failed_keys = [ s3_key for s3_key, response in zip(s3_keys, responses) if response is None or response[1] ]
+        if failed_keys:
+            # the alias keeps pointing to the complete old index
+            drop_rebuild_index(get_aos_client(), write_index)
+            raise RuntimeError(f"rebuild of {AOS_INDEX} aborted, {write_index} was not swapped in, failed files: {failed_keys}")
+        finish_rebuild(get_aos_client(), bucket, AOS_INDEX, write_index, restore_settings)
+
+    if PUBLISH_GLOSSARY_SNAPSHOT:
+        failed_keys = [ s3_key for s3_key, response in zip(s3_keys, responses) if response is None or response[1] ]
+        if failed_keys:
+            # the previous snapshot stays current until an ingest is complete
+            print(f"glossary snapshot not published, failed files: {failed_keys}")
+        else:
+            publish_glossary_snapshot(get_aos_client(), bucket, AOS_INDEX, GLOSSARY_SNAPSHOT_PREFIX)
+    return responses
+
+def publish_glossary_snapshot(client, bucket, index, prefix):
+    # written from the index rather than the ingested files, so the snapshot holds every term the translate job could retrieve
+    client.indices.refresh(index=index)
+    query = {"query": {"terms": {"doc_type": SNAPSHOT_DOC_TYPES}}}
+    def iterate_terms():
+        for item in helpers.scan(client, query=query, index=index, _source=['idx', 'doc_type', 'content', 'doc_category', 'terms'], size=5000):
+            source = item['_source']
+            # a grouped document holds its terms in `terms`
+            for content in source.get('terms') or [source['content']]:
+                yield source['doc_type'], content, source['doc_category'], source.get('idx', 0)
+
+    version, data = build_snapshot(iterate_terms())
+    snapshot_key = get_snapshot_key(prefix, version)
+    s3.Bucket(bucket).put_object(Key=snapshot_key, Body=data)
+    s3.Bucket(bucket).put_object(Key=get_latest_snapshot_key(prefix), Body=json.dumps({'version': version, 'key': snapshot_key, 'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}).encode('utf-8'))
+    print(f"published glossary snapshot {version} ({len(data)} bytes) to s3://{bucket}/{snapshot_key}")
+    return version
+
+if __name__ == '__main__':
+    s3_keys = [ normalize_s3_key(s3_key) for s3_key in object_key.split(',') ]
+    print("processing {}".format(s3_keys))
+    responses = ingest_files(bucket, s3_keys)
+    failed_keys = [ s3_key for s3_key, response in zip(s3_keys, responses) if response is None or response[1] ]
+    if failed_keys:
+        # fail the glue run, so the scheduler and the console do not report a partial ingest as a success
+        raise RuntimeError(f"{len(failed_keys)} of {len(s3_keys)} files failed: {failed_keys}")
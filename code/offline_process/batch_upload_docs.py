@@ -1,66 +1,164 @@
 import boto3
 import time
 import os
-import time
 import argparse
-import itertools
 import datetime
 import math
+import heapq
+import random
+import uuid
+from collections import deque
+from botocore.exceptions import ClientError
 
-def update_running_job_set(job_name, running_job_id_set):
-    response = glue.get_job_runs(JobName=job_name)
+FINISHED_STATES = ['STOPPED', 'SUCCEEDED', 'FAILED', 'ERROR', 'TIMEOUT']
+# start_job_run errors that no retry of the same request can fix, e.g. a wrong job name or missing permissions
+NON_RETRYABLE_START_ERRORS = ['EntityNotFoundException', 'InvalidInputException', 'AccessDeniedException', 'ValidationException']
 
-    # Filter the finished job runs
-    finish_runs_id = [run['Id'] for run in response['JobRuns'] if run['JobRunState'] in ['STOPPED', 'SUCCEEDED', 'FAILED', 'ERROR', 'TIMEOUT'] ]
-    
-    return running_job_id_set - set(finish_runs_id)
-        
-def list_s3_objects(s3_client,bucket_name, prefix=''):
-    objects = []
-    paginator = s3_client.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
-    # iterate over pages
-    for page in page_iterator:
-        # loop through objects in page
-        if 'Contents' in page:
-            for obj in page['Contents']:
-                yield obj['Key']
-        # if there are more pages to fetch, continue
-        if 'NextContinuationToken' in page:
-            page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix,
-                                                ContinuationToken=page['NextContinuationToken'])
-def count_s3_files(s3_client, bucket_name, prefix):
+def list_s3_objects(s3_client, bucket_name, prefix=''):
+    # yields (key, size) of every file under prefix, the paginator follows the continuation tokens
     paginator = s3_client.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
-    file_count = 0
-    for page in page_iterator:
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
         for obj in page.get('Contents', []):
             if not obj['Key'].endswith('/'):
-                file_count += 1
-    return file_count
+                yield obj['Key'], obj['Size']
+
+def bin_pack_objects(objects, batch_count, max_keys_per_batch):
+    # largest file first into the currently smallest batch, so every batch gets about the same number of bytes
+    # a batch never holds more than max_keys_per_batch keys because all keys go into one job argument
+    bins = [ (0, idx) for idx in range(batch_count) ]
+    batches = [ [] for _ in range(batch_count) ]
+    batch_bytes = [ 0 ] * batch_count
+    for key, size in sorted(objects, key=lambda obj: obj[1], reverse=True):
+        if not bins:
+            bins = [ (0, len(batches)) ]
+            batches.append([])
+            batch_bytes.append(0)
+        _, idx = heapq.heappop(bins)
+        batches[idx].append(key)
+        batch_bytes[idx] += size
+        if len(batches[idx]) < max_keys_per_batch:
+            heapq.heappush(bins, (batch_bytes[idx], idx))
 
+    plan = [ (batch, size) for batch, size in zip(batches, batch_bytes) if batch ]
+    # start the biggest batches first so they do not end up as the tail of the backfill
+    plan.sort(key=lambda item: item[1], reverse=True)
+    return plan
 
 def start_job(glue_client, job_name, key_path, aos_endpoint, bucket, region_name, model_id):
-    print('start job for {} at {}'.format(key_path, str(publish_date)))   
-    response = glue.start_job_run(
+    print('start job for {} at {}'.format(key_path, str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))))
+    response = glue_client.start_job_run(
         JobName=job_name,
         Arguments={
             '--AOS_ENDPOINT':aos_endpoint,
             '--REGION':region_name,
             '--AOS_INDEX': "rag-data-index",
             '--additional-python-modules': 'boto3>=1.28.52,botocore>=1.31.52',
-            '--model_id': 'anthropic.claude-3-sonnet-20240229-v1:0',
+            '--model_id': model_id,
             '--object_key': key_path,
             '--bucket': bucket,
-            })  
+            })
     return response['JobRunId']
 
-def batch_generator(generator, batch_size):
-    while True:
-        batch = list(itertools.islice(generator, batch_size))
-        if not batch:
-            break
-        yield batch
+class FakeGlueClient():
+    # local stand-in for the glue client, runs take startup_seconds + bytes / bytes_per_second on a virtual clock
+    def __init__(self, startup_seconds=60, bytes_per_second=1024 * 1024, failure_rate=0.0, seed=0):
+        self.now = 0.0
+        self.startup_seconds = startup_seconds
+        self.bytes_per_second = bytes_per_second
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.object_sizes = {}
+        self.runs = {}
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def start_job_run(self, JobName, Arguments):
+        run_id = f"jr_{uuid.uuid4().hex}"
+        keys = Arguments['--object_key'].split(',')
+        duration = self.startup_seconds + sum(self.object_sizes.get(key, 0) for key in keys) / self.bytes_per_second
+        final_state = 'FAILED' if self.random.random() < self.failure_rate else 'SUCCEEDED'
+        self.runs[run_id] = (self.now + duration, final_state)
+        return {'JobRunId': run_id}
+
+    def get_job_run(self, JobName, RunId):
+        finish_time, final_state = self.runs[RunId]
+        state = final_state if self.now >= finish_time else 'RUNNING'
+        return {'JobRun': {'Id': RunId, 'JobRunState': state}}
+
+class GlueJobScheduler():
+    def __init__(self, glue_client, job_name, start_job_func, concurrent_runs_quota, max_attempts=3,
+                 min_poll_interval=5, max_poll_interval=60, sleep=time.sleep, clock=time.time):
+        self.glue_client = glue_client
+        self.job_name = job_name
+        self.start_job_func = start_job_func
+        self.concurrent_runs_quota = concurrent_runs_quota
+        self.max_attempts = max_attempts
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.sleep = sleep
+        self.clock = clock
+
+    def poll_finished_runs(self, running):
+        # targeted get_job_run per running id, get_job_runs only returns the latest page of runs
+        finished = []
+        for run_id in list(running):
+            try:
+                state = self.glue_client.get_job_run(JobName=self.job_name, RunId=run_id)['JobRun']['JobRunState']
+            except Exception as e:
+                print(f"failed to get state of job run {run_id}: {str(e)}")
+                continue
+            if state in FINISHED_STATES:
+                finished.append((run_id, state))
+        return finished
+
+    def run(self, plan):
+        # plan is [(keys, bytes)], returns the batches that still failed after max_attempts
+        start_time = self.clock()
+        pending = deque((idx, keys, 1) for idx, (keys, size) in enumerate(plan))
+        running = {}
+        failed_batches = []
+        poll_interval = self.min_poll_interval
+
+        while pending or running:
+            # refill every free slot right away
+            while pending and len(running) < self.concurrent_runs_quota:
+                idx, keys, attempt = pending.popleft()
+                try:
+                    run_id = self.start_job_func(self.glue_client, ','.join(keys))
+                except Exception as e:
+                    if isinstance(e, ClientError) and e.response['Error']['Code'] in NON_RETRYABLE_START_ERRORS:
+                        raise
+                    # e.g. ConcurrentRunsExceededException caused by runs started outside this scheduler,
+                    # a failed start uses up an attempt so a start that keeps failing cannot loop forever
+                    print(f"[{idx}] attempt {attempt} failed to start job run: {str(e)}")
+                    if attempt < self.max_attempts:
+                        pending.appendleft((idx, keys, attempt + 1))
+                    else:
+                        failed_batches.append((idx, keys))
+                    break
+                running[run_id] = (idx, keys, attempt)
+                print("[{}] attempt {} started {}, running job count: {}".format(idx, attempt, run_id, len(running)))
+
+            self.sleep(poll_interval)
+            finished = self.poll_finished_runs(running)
+            # poll quickly while runs are finishing, back off while nothing changes
+            poll_interval = self.min_poll_interval if finished else min(poll_interval * 2, self.max_poll_interval)
+
+            for run_id, state in finished:
+                idx, keys, attempt = running.pop(run_id)
+                print("[{}] job run {} finished with {}".format(idx, run_id, state))
+                if state == 'SUCCEEDED':
+                    continue
+                if attempt < self.max_attempts:
+                    pending.append((idx, keys, attempt + 1))
+                else:
+                    failed_batches.append((idx, keys))
+
+        print(f"{len(plan)} batches done in {self.clock() - start_time:.0f}s, {len(failed_batches)} failed")
+        for idx, keys in failed_batches:
+            print(f"[{idx}] failed batch: {','.join(keys)}")
+        return failed_batches
 
 
 if __name__ == '__main__':
@@ -72,8 +170,15 @@ if __name__ == '__main__':
     parser.add_argument('--concurrent_runs_quota', type=int, default=50, help='quota of concurrent job runs')
     parser.add_argument('--job_name', type=str, default='chatbotfroms3toaosF98BA633-QxSQwoaGE1K9', help='job name')
     parser.add_argument('--model_id', type=str, default='anthropic.claude-3-sonnet-20240229-v1:0', help='model_id')
+    parser.add_argument('--batch_mb', type=float, default=0, help='target size of one batch in MB, 0 means total size / concurrent_runs_quota')
+    parser.add_argument('--max_keys_per_batch', type=int, default=200, help='max number of files in one job run')
+    parser.add_argument('--max_attempts', type=int, default=3, help='attempts per batch before it is reported as failed')
+    parser.add_argument('--min_poll_interval', type=float, default=5, help='seconds between polls while runs are finishing')
+    parser.add_argument('--max_poll_interval', type=float, default=60, help='max seconds between polls while nothing finishes')
+    parser.add_argument('--dry_run', action='store_true', help='only print the batch plan')
+    parser.add_argument('--fake_glue', action='store_true', help='simulate the job runs with a local fake glue client')
     args = parser.parse_args()
-    
+
     region = args.region
     bucket = args.bucket
     aos_endpoint = args.aos_endpoint
@@ -82,30 +187,36 @@ if __name__ == '__main__':
     job_name = args.job_name
     model_id = args.model_id
 
-    glue = boto3.client('glue', region)
     s3 = boto3.client('s3', region)
-    
-    running_job_id_set = set()
-
-    file_cnt = count_s3_files(s3, bucket_name=bucket, prefix=path_prefix)
-    batch_size = math.ceil(file_cnt / concurrent_runs_quota)
-    print(f"file_cnt: {file_cnt}, batch_size:{batch_size}")
-    
-    file_generator = list_s3_objects(s3, bucket_name=bucket, prefix=path_prefix)
-    
-    batches = batch_generator(file_generator, batch_size)
-    publish_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-
-    for idx, batch in enumerate(batches):
-        key_list_str = ','.join(batch)
-        while len(running_job_id_set) >= concurrent_runs_quota:
-            print('wait for previous running job done')
-            time.sleep(100)
-            running_job_id_set = update_running_job_set(job_name, running_job_id_set)
-            print('concurrent_running: {}'.format(running_job_id_set))
-            
-        running_job_id=start_job(glue, job_name, key_list_str, aos_endpoint, bucket, region, model_id)
-        running_job_id_set.add(running_job_id)
-        # sleep_seconds = len(running_job_id_set) * 2
-        print("[{}] running job count: {}".format(idx, len(running_job_id_set)))
-        time.sleep(15)
\ No newline at end of file
+
+    # list the prefix once, keys and sizes are both needed for the plan
+    objects = list(list_s3_objects(s3, bucket_name=bucket, prefix=path_prefix))
+    total_bytes = sum(size for key, size in objects)
+    if args.batch_mb > 0:
+        batch_count = max(1, math.ceil(total_bytes / (args.batch_mb * 1024 * 1024)))
+    else:
+        batch_count = concurrent_runs_quota
+    plan = bin_pack_objects(objects, min(batch_count, max(1, len(objects))), args.max_keys_per_batch)
+    print(f"file_cnt: {len(objects)}, total_mb: {total_bytes / 1024 / 1024:.1f}, batch_cnt: {len(plan)}")
+
+    if args.dry_run:
+        for idx, (keys, size) in enumerate(plan):
+            print(f"[{idx}] {len(keys)} files, {size / 1024 / 1024:.1f} MB: {','.join(keys)}")
+        exit(0)
+
+    if args.fake_glue:
+        glue = FakeGlueClient()
+        glue.object_sizes = dict(objects)
+        sleep, clock = glue.sleep, lambda: glue.now
+    else:
+        glue = boto3.client('glue', region)
+        sleep, clock = time.sleep, time.time
+
+    scheduler = GlueJobScheduler(glue, job_name,
+                                 lambda glue_client, key_list_str: start_job(glue_client, job_name, key_list_str, aos_endpoint, bucket, region, model_id),
+                                 concurrent_runs_quota, max_attempts=args.max_attempts,
+                                 min_poll_interval=args.min_poll_interval, max_poll_interval=args.max_poll_interval,
+                                 sleep=sleep, clock=clock)
+    failed_batches = scheduler.run(plan)
+    if failed_batches:
+        exit(1)
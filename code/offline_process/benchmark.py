@@ -0,0 +1,724 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# offline throughput benchmark of rag_based_translate.py and aos_write_job.py
+# runs both pipelines against an in-memory search backend and a fake bedrock, no AWS access is needed
+#
+#   python benchmark.py --pipeline translate --terms 10000 --segments 2000 --bedrock_latency_ms 800 --job_args="--max_workers 16"
+#   python benchmark.py --pipeline ingest --terms 1000000 --job_args="--streaming true --bulk_threads 8"
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import re
+import resource
+import shlex
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from botocore.exceptions import ClientError
+from opensearchpy.serializer import JSONSerializer
+
+from glossary_snapshot import build_snapshot, get_snapshot_key, get_latest_snapshot_key
+
+BENCH_BUCKET = 'benchmark-bucket'
+TOKEN_PATTERN = re.compile(r'[㐀-䶿一-鿿]|\w+')
+
+class StageTimer():
+    # collects wall time samples per stage from any thread
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    @staticmethod
+    def percentile(values, q):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)]
+
+    def summary(self):
+        return { stage: {'count': len(values),
+                         'p50_ms': round(self.percentile(values, 0.5) * 1000, 2),
+                         'p99_ms': round(self.percentile(values, 0.99) * 1000, 2),
+                         'total_s': round(sum(values), 3)}
+                 for stage, values in self.samples.items() if values }
+
+class FakeTransport():
+    serializer = JSONSerializer()
+
+class FakeIndicesClient():
+    # index settings, mappings and aliases only, the documents of every index share one FakeSearchBackend store
+    def __init__(self):
+        self.indices = {}
+        self.aliases = defaultdict(set)
+        self.calls = []
+
+    def exists(self, index):
+        return index in self.indices
+
+    def exists_alias(self, name):
+        return bool(self.aliases.get(name))
+
+    def get_alias(self, name):
+        return { index: {'aliases': {name: {}}} for index in self.aliases.get(name, []) }
+
+    def get(self, index):
+        if index.endswith('*'):
+            return { name: meta for name, meta in self.indices.items() if name.startswith(index[:-1]) }
+        return {index: self.indices[index]}
+
+    def create(self, index, body=None, **kwargs):
+        body = body or {}
+        self.indices[index] = {'settings': {'index': dict(body.get('settings', {}).get('index', {}), uuid=index)}, 'mappings': body.get('mappings', {})}
+        self.calls.append(('create', index))
+
+    def put_settings(self, index, body, **kwargs):
+        self.indices[index]['settings']['index'].update(body['index'])
+        self.calls.append(('put_settings', index))
+
+    def refresh(self, index, **kwargs):
+        self.calls.append(('refresh', index))
+
+    def forcemerge(self, index, **kwargs):
+        self.calls.append(('forcemerge', index))
+
+    def update_aliases(self, body, **kwargs):
+        for action in body['actions']:
+            op, spec = next(iter(action.items()))
+            if op == 'add':
+                self.aliases[spec['alias']].add(spec['index'])
+            elif op == 'remove':
+                self.aliases[spec['alias']].discard(spec['index'])
+            elif op == 'remove_index':
+                self.indices.pop(spec['index'], None)
+        self.calls.append(('update_aliases', body['actions']))
+
+    def delete(self, index, **kwargs):
+        self.indices.pop(index, None)
+        for indices in self.aliases.values():
+            indices.discard(index)
+        self.calls.append(('delete', index))
+
+class FakeClusterClient():
+    def health(self, index=None, **kwargs):
+        return {'status': 'green'}
+
+class FakeSearchBackend():
+    # in-memory stand-in for the OpenSearch client, supports the query shapes used by the jobs:
+    # bool(must match / knn, filter term / terms), search, msearch, bulk, scan and delete_by_query
+    transport = FakeTransport()
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.indices = FakeIndicesClient()
+        self.cluster = FakeClusterClient()
+        self.docs = {}
+        self.postings = defaultdict(set)
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+    @staticmethod
+    def tokenize(text):
+        return TOKEN_PATTERN.findall(str(text).lower())
+
+    def wait(self):
+        with self.lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def index_doc(self, doc_id, source):
+        with self.lock:
+            self.delete_doc(doc_id)
+            self.docs[doc_id] = source
+            for field, value in source.items():
+                if field in ['content', 'terms'] or field.startswith('term_'):
+                    values = value if isinstance(value, list) else [value]
+                    for token in set(token for item in values for token in self.tokenize(item)):
+                        self.postings[(field, token)].add(doc_id)
+
+    def delete_doc(self, doc_id):
+        source = self.docs.pop(doc_id, None)
+        if source is None:
+            return False
+        for field, value in source.items():
+            if field in ['content', 'terms'] or field.startswith('term_'):
+                values = value if isinstance(value, list) else [value]
+                for token in set(token for item in values for token in self.tokenize(item)):
+                    self.postings[(field, token)].discard(doc_id)
+        return True
+
+    def match_filter(self, source, clause):
+        if 'term' in clause:
+            field, value = next(iter(clause['term'].items()))
+            value = value['value'] if isinstance(value, dict) else value
+            actual = source.get(field)
+            return value in actual if isinstance(actual, list) else actual == value
+        if 'terms' in clause:
+            field, values = next(iter(clause['terms'].items()))
+            return source.get(field) in values
+        return True
+
+    def run_query(self, body):
+        query = body.get('query', {'match_all': {}})
+        bool_query = query.get('bool', {})
+        filters = bool_query.get('filter', [])
+        filters = filters if isinstance(filters, list) else [filters]
+        must = bool_query.get('must', {})
+        if 'terms' in query or 'term' in query:
+            filters = [query]
+
+        scores = {}
+        tokens = set()
+        if 'match' in must or 'multi_match' in must:
+            if 'match' in must:
+                field, text = next(iter(must['match'].items()))
+                text = text['query'] if isinstance(text, dict) else text
+                fields = [field]
+            else:
+                text, fields = must['multi_match']['query'], must['multi_match']['fields']
+            tokens = set(self.tokenize(text))
+            total = max(1, len(self.docs))
+            # best_fields, the score of the best matching field
+            for field in fields:
+                field_scores = {}
+                for token in tokens:
+                    doc_ids = self.postings.get((field, token), ())
+                    idf = math.log(1 + total / (1 + len(doc_ids)))
+                    for doc_id in doc_ids:
+                        field_scores[doc_id] = field_scores.get(doc_id, 0.0) + idf
+                for doc_id, score in field_scores.items():
+                    scores[doc_id] = max(scores.get(doc_id, 0.0), score)
+        elif 'knn' in must:
+            field, params = next(iter(must['knn'].items()))
+            vector = params['vector']
+            for doc_id, source in self.docs.items():
+                if field in source:
+                    cosine = sum(a * b for a, b in zip(vector, source[field]))
+                    # the score of nmslib's cosinesimil space
+                    scores[doc_id] = 1 / (2 - cosine)
+        else:
+            scores = { doc_id: 1.0 for doc_id in self.docs }
+
+        hits = [ {'_id': doc_id, '_score': score, '_source': self.docs[doc_id]} for doc_id, score in scores.items()
+                 if doc_id in self.docs and all(self.match_filter(self.docs[doc_id], clause) for clause in filters) ]
+        min_score = body.get('min_score')
+        if min_score is not None:
+            hits = [ hit for hit in hits if hit['_score'] >= min_score ]
+        hits.sort(key=lambda hit: hit['_score'], reverse=True)
+        hits = hits[:body.get('size', 10)]
+        for field in body.get('highlight', {}).get('fields', {}):
+            for hit in hits:
+                values = hit['_source'].get(field)
+                values = values if isinstance(values, list) else [values] if values else []
+                highlights = [ TOKEN_PATTERN.sub(lambda match: f"<em>{match.group(0)}</em>" if match.group(0).lower() in tokens else match.group(0), value)
+                               for value in values if tokens.intersection(self.tokenize(value)) ]
+                if highlights:
+                    hit['highlight'] = {field: highlights}
+        source_filter = body.get('_source')
+        if isinstance(source_filter, (list, dict)):
+            includes = source_filter if isinstance(source_filter, list) else source_filter.get('includes')
+            excludes = [] if isinstance(source_filter, list) else source_filter.get('excludes', [])
+            hits = [ dict(hit, _source={ key: value for key, value in hit['_source'].items() if (includes is None or key in includes) and key not in excludes }) for hit in hits ]
+        return {'_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                'hits': {'total': {'value': len(hits)}, 'hits': hits}}
+
+    def search(self, body=None, index=None, params=None, **kwargs):
+        self.wait()
+        if kwargs.get('scroll') or (params or {}).get('scroll'):
+            # the whole result in one page, scan then stops on the empty scroll
+            body = dict(body or {}, size=len(self.docs) + 1)
+            response = self.run_query(body)
+            response['_scroll_id'] = 'benchmark'
+            return response
+        return self.run_query(body or {})
+
+    def scroll(self, *args, **kwargs):
+        return {'_scroll_id': 'benchmark', 'hits': {'hits': []}}
+
+    def clear_scroll(self, *args, **kwargs):
+        return {}
+
+    def msearch(self, body, index=None, **kwargs):
+        self.wait()
+        lines = body if isinstance(body, list) else [ json.loads(line) for line in body.strip().split('\n') ]
+        return {'responses': [ self.run_query(lines[pos + 1]) for pos in range(0, len(lines), 2) ]}
+
+    def bulk(self, body, index=None, **kwargs):
+        self.wait()
+        lines = body if isinstance(body, list) else body.strip().split('\n')
+        lines = [ json.loads(line) if isinstance(line, (str, bytes)) else line for line in lines ]
+        items = []
+        pos = 0
+        while pos < len(lines):
+            op_type, meta = next(iter(lines[pos].items()))
+            pos += 1
+            if op_type == 'delete':
+                with self.lock:
+                    status = 200 if self.delete_doc(meta['_id']) else 404
+            else:
+                self.index_doc(meta.get('_id') or f"auto_{random.getrandbits(64):x}", lines[pos])
+                pos += 1
+                status = 201
+            items.append({op_type: {'_id': meta.get('_id'), 'status': status}})
+        return {'errors': any(next(iter(item.values()))['status'] >= 300 for item in items), 'items': items}
+
+    def delete_by_query(self, index=None, body=None, **kwargs):
+        self.wait()
+        with self.lock:
+            doc_ids = [ hit['_id'] for hit in self.run_query(dict(body, size=len(self.docs) + 1))['hits']['hits'] ]
+            for doc_id in doc_ids:
+                self.delete_doc(doc_id)
+        return {'deleted': len(doc_ids)}
+
+class FakeStreamingBody():
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self.stream.read(amt)
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def iter_lines(self, chunk_size=1024):
+        for line in self.stream:
+            yield line.rstrip(b'\r\n')
+
+class FakeMultipartUpload():
+    def __init__(self, s3_object):
+        self.s3_object = s3_object
+        self.parts = {}
+
+    def Part(self, part_number):
+        upload = self
+        class FakeMultipartUploadPart():
+            def upload(self, Body):
+                upload.parts[part_number] = Body
+                return {'ETag': f'"{part_number}"'}
+        return FakeMultipartUploadPart()
+
+    def complete(self, MultipartUpload):
+        self.s3_object.put(b''.join(self.parts[part['PartNumber']] for part in MultipartUpload['Parts']))
+        return {}
+
+    def abort(self):
+        self.parts = {}
+
+class FakeS3Object():
+    def __init__(self, store, bucket, key):
+        self.store = store
+        self.key = (bucket, key)
+
+    def get(self):
+        if self.key not in self.store.objects:
+            raise self.store.meta.client.exceptions.NoSuchKey({'Error': {'Code': 'NoSuchKey', 'Message': str(self.key)}}, 'GetObject')
+        return {'Body': FakeStreamingBody(self.store.objects[self.key])}
+
+    def put(self, Body, **kwargs):
+        self.store.objects[self.key] = Body if isinstance(Body, bytes) else Body.encode('utf-8')
+        return {}
+
+    def initiate_multipart_upload(self, **kwargs):
+        return FakeMultipartUpload(self)
+
+class FakeS3ObjectCollection():
+    def __init__(self, store, bucket, prefix=''):
+        self.store = store
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def filter(self, Prefix=''):
+        return FakeS3ObjectCollection(self.store, self.bucket, Prefix)
+
+    def __iter__(self):
+        keys = sorted(key for bucket, key in self.store.objects if bucket == self.bucket and key.startswith(self.prefix))
+        return iter([ type('ObjectSummary', (), {'key': key}) for key in keys ])
+
+    def delete(self):
+        for summary in list(self):
+            del self.store.objects[(self.bucket, summary.key)]
+
+class FakeS3Bucket():
+    def __init__(self, store, bucket):
+        self.store = store
+        self.bucket = bucket
+        self.objects = FakeS3ObjectCollection(store, bucket)
+
+    def put_object(self, Key, Body, **kwargs):
+        return FakeS3Object(self.store, self.bucket, Key).put(Body)
+
+    def download_file(self, key, filename):
+        with open(filename, 'wb') as f:
+            f.write(FakeS3Object(self.store, self.bucket, key).get()['Body'].read())
+
+    def upload_file(self, filename, key):
+        with open(filename, 'rb') as f:
+            FakeS3Object(self.store, self.bucket, key).put(f.read())
+
+class FakeS3Resource():
+    # the subset of boto3.resource('s3') used by the jobs, objects live in a dict
+    class NoSuchKey(ClientError):
+        pass
+
+    def __init__(self):
+        self.objects = {}
+        exceptions = type('exceptions', (), {'NoSuchKey': FakeS3Resource.NoSuchKey})
+        self.meta = type('meta', (), {'client': type('client', (), {'exceptions': exceptions})})
+
+    def Object(self, bucket, key):
+        return FakeS3Object(self, bucket, key)
+
+    def Bucket(self, bucket):
+        return FakeS3Bucket(self, bucket)
+
+class FakeBedrock():
+    # answers translate prompts with a dummy translation after a lognormal latency,
+    # and fails with the configured throttling / error rates
+    def __init__(self, latency_ms=800.0, latency_sigma=0.5, ms_per_output_token=0.0, throttle_rate=0.0, error_rate=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.ms_per_output_token = ms_per_output_token
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def draw(self):
+        with self.lock:
+            self.calls += 1
+            latency = self.random.lognormvariate(math.log(max(self.latency_ms, 1e-3)), self.latency_sigma) / 1000.0
+            outcome = self.random.random()
+            if outcome < self.throttle_rate:
+                self.throttled += 1
+                return latency / 10, 'throttle'
+            if outcome < self.throttle_rate + self.error_rate:
+                self.errors += 1
+                return latency, 'error'
+            return latency, 'ok'
+
+    @staticmethod
+    def prompt_text(request):
+        content = request['messages'][0]['content']
+        if isinstance(content, list):
+            content = ''.join(block.get('text', '') for block in content)
+        return content
+
+    @staticmethod
+    def build_answer(prompt, prefill):
+        segments = re.findall(r'<segment id="(\d+)">\n(.*?)\n</segment>', prompt, re.S)
+        if segments:
+            answer = '\n'.join(f'<translation id="{seg_id}">[translated] {text}</translation>' for seg_id, text in segments)
+        else:
+            match = re.search(r'<content>\n(.*?)\n</content>', prompt, re.S)
+            answer = f"[translated] {match.group(1) if match else ''}"
+        return answer
+
+    def invoke_model(self, body, modelId, **kwargs):
+        request = json.loads(body)
+        latency, outcome = self.draw()
+        if 'inputText' in request or 'texts' in request:
+            time.sleep(latency / 4)
+            texts = request.get('texts') or [request['inputText']]
+            vectors = [ [ self.random.uniform(-1, 1) for _ in range(request.get('dimensions', 1024)) ] for _ in texts ]
+            payload = {'embeddings': vectors} if 'texts' in request else {'embedding': vectors[0]}
+            return {'body': FakeStreamingBody(json.dumps(payload).encode('utf-8'))}
+
+        prompt = self.prompt_text(request)
+        prefill = request['messages'][-1]['content'] if request['messages'][-1]['role'] == 'assistant' else ''
+        answer = self.build_answer(prompt, prefill)
+        output_tokens = max(1, len(answer) // 4)
+        time.sleep(latency + output_tokens * self.ms_per_output_token / 1000.0)
+        if outcome == 'throttle':
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Too many requests'}}, 'InvokeModel')
+        if outcome == 'error':
+            raise ClientError({'Error': {'Code': 'ServiceUnavailableException', 'Message': 'Service unavailable'}}, 'InvokeModel')
+
+        payload = {'content': [{'type': 'text', 'text': answer}],
+                   'stop_reason': 'stop_sequence',
+                   'usage': {'input_tokens': max(1, len(prompt) // 4), 'output_tokens': output_tokens}}
+        return {'body': FakeStreamingBody(json.dumps(payload, ensure_ascii=False).encode('utf-8'))}
+
+def random_word(rng, min_len=4, max_len=10):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(min_len, max_len)))
+
+def random_cn_word(rng, length=3):
+    return ''.join(chr(rng.randint(0x4e00, 0x9fa5)) for _ in range(length))
+
+def make_glossaries(term_count, rng, terms_per_item=5):
+    # half protected terms, half EN/CN mappings, returns (crosslingual json, multilingual json, surface forms)
+    cross_count = term_count // 2
+    cross_items = []
+    terms = []
+    for start in range(0, cross_count, terms_per_item):
+        item_terms = [ random_word(rng).capitalize() for _ in range(min(terms_per_item, cross_count - start)) ]
+        terms.extend(item_terms)
+        cross_items.append({"terms": item_terms, "entity_type": rng.choice(["Service", "Feature", "Characters"])})
+
+    multi_items = []
+    for _ in range(term_count - cross_count):
+        en_term = random_word(rng).upper()
+        terms.append(en_term)
+        multi_items.append({"mapping": {"EN": en_term, "CN": random_cn_word(rng)}, "entity_type": rng.choice(["Brand", "Product"])})
+
+    crosslingual = {"type": "crosslingual_terminology", "author": "benchmark", "data": cross_items}
+    multilingual = {"type": "multilingual_terminology", "author": "benchmark", "data": multi_items}
+    return crosslingual, multilingual, terms
+
+def make_source_file(segment_count, terms, rng, duplicate_rate=0.1, term_rate=0.5):
+    segments = []
+    for _ in range(segment_count):
+        if segments and rng.random() < duplicate_rate:
+            segments.append(rng.choice(segments))
+            continue
+        words = [ random_word(rng, 2, 8) for _ in range(rng.randint(4, 20)) ]
+        if terms and rng.random() < term_rate:
+            words.insert(rng.randint(0, len(words)), rng.choice(terms))
+        segments.append(' '.join(words))
+    return {"src_lang": "EN", "dest_lang": "CN", "src_content": segments}
+
+def index_glossary(backend, glossary, group_terms=0):
+    # same documents as aos_write_job.iterate_items writes, without going through the ingest job
+    doc_type = glossary['type']
+    if doc_type == 'crosslingual_terminology' and group_terms > 0:
+        # like aos_write_job --group_terms
+        groups = defaultdict(list)
+        for item in glossary['data']:
+            groups[item['entity_type']].extend(item['terms'])
+        for entity_type, terms in groups.items():
+            for start in range(0, len(terms), group_terms):
+                backend.index_doc(f"{doc_type}_{entity_type}_{start}", {"idx": 0, "doc_type": doc_type, "content": '', "terms": terms[start:start + group_terms],
+                                                                       "doc_category": entity_type, "doc_title": "benchmark"})
+        return
+    for idx, item in enumerate(glossary['data']):
+        if doc_type == 'crosslingual_terminology':
+            for term in item['terms']:
+                backend.index_doc(f"{doc_type}_{idx}_{term}", {"idx": idx, "doc_type": doc_type, "content": term, "doc_category": item['entity_type'], "doc_title": "benchmark"})
+        else:
+            source = {"idx": idx, "doc_type": doc_type, "content": json.dumps(item['mapping']), "doc_category": item['entity_type'], "doc_title": "benchmark",
+                      "langs": list(item['mapping'])}
+            source.update({ f"term_{lang}": term for lang, term in item['mapping'].items() })
+            backend.index_doc(f"{doc_type}_{idx}", source)
+
+def import_job(module_name, job_args):
+    sys.argv = [module_name] + job_args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    return __import__(module_name)
+
+def peak_rss_mb():
+    # ru_maxrss is KB on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def silenced(quiet):
+    return contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext()
+
+def setup_translate(args, rng, timer):
+    crosslingual, multilingual, terms = make_glossaries(args.terms, rng)
+    s3 = FakeS3Resource()
+    s3.Object(BENCH_BUCKET, 'kb/crosslingual_terminology.json').put(json.dumps(crosslingual, ensure_ascii=False))
+    s3.Object(BENCH_BUCKET, 'kb/multilingual_terminology.json').put(json.dumps(multilingual, ensure_ascii=False))
+    source_keys = []
+    for file_idx in range(args.files):
+        source = make_source_file(args.segments, terms, rng)
+        if args.source_format == 'jsonl':
+            key = f"src_files/bench_{file_idx}.jsonl"
+            s3.Object(BENCH_BUCKET, key).put("".join(json.dumps({'id': f"{file_idx}-{idx}", 'src_content': segment}, ensure_ascii=False) + "\n"
+                                                     for idx, segment in enumerate(source['src_content'])))
+        else:
+            key = f"src_files/bench_{file_idx}.json"
+            s3.Object(BENCH_BUCKET, key).put(json.dumps(source, ensure_ascii=False))
+        source_keys.append(key)
+
+    job_args = ['--bucket', BENCH_BUCKET, '--object_key', ','.join(source_keys), '--model_id', 'benchmark-model',
+                '--AOS_ENDPOINT', 'benchmark', '--REGION', 'us-east-1', '--AOS_INDEX', 'rag-data-index'] + shlex.split(args.job_args)
+    job = import_job('rag_based_translate', job_args)
+
+    backend = FakeSearchBackend(latency_ms=args.search_latency_ms)
+    index_glossary(backend, crosslingual, args.group_terms if job.GROUPED_TERMS else 0)
+    index_glossary(backend, multilingual)
+    if job.RETRIEVAL_ENGINE == 'snapshot':
+        # what aos_write_job publishes with --glossary_snapshot true after ingesting the glossaries
+        version, data = build_snapshot((source['doc_type'], source['content'], source['doc_category'], source['idx']) for source in backend.docs.values())
+        s3.Object(BENCH_BUCKET, get_snapshot_key(job.GLOSSARY_SNAPSHOT_PREFIX, version)).put(data)
+        s3.Object(BENCH_BUCKET, get_latest_snapshot_key(job.GLOSSARY_SNAPSHOT_PREFIX)).put(json.dumps({'version': version}))
+
+    bedrock = FakeBedrock(latency_ms=args.bedrock_latency_ms, latency_sigma=args.bedrock_latency_sigma, ms_per_output_token=args.ms_per_output_token,
+                          throttle_rate=args.throttle_rate, error_rate=args.error_rate, seed=args.seed)
+    job.s3 = s3
+    job.bedrock = bedrock
+    if job.TRANSLATION_MEMORY_ENABLED:
+        # opened in the job's __main__, which is not run here
+        job.translation_memory = job.TranslationMemory.from_s3(BENCH_BUCKET, job.TM_S3_KEY, job.TM_LOCAL_PATH, job.TM_MAX_BYTES)
+    embedder = None
+    if job.RETRIEVAL_MODE == 'hybrid':
+        embedder = job.get_embedder(job.EMBEDDING_MODEL, bedrock, job.EMBEDDING_DIMENSION)
+    retriever_class = job.TerminologyRetriever
+    retriever_class.from_endpoints = classmethod(lambda cls, endpoint, index: cls(endpoint, index, backend, embedder))
+
+    # every stage is looked up as a module global at call time, so wrapping the globals times the real call sites
+    for stage in ['load_content_json_from_s3', 'retrieve_glossary_context', 'construct_translate_prompt', 'invoke_bedrock', 'translate_by_llm', 'translate_file']:
+        setattr(job, stage, timer.wrap(stage, getattr(job, stage)))
+    retriever_class.batch_search_aos_for_terminology = timer.wrap('batch_search_aos_for_terminology', retriever_class.batch_search_aos_for_terminology)
+    return job, s3, backend, bedrock, source_keys
+
+def count_translated(job, s3, source_keys):
+    translated = 0
+    total = 0
+    for key in source_keys:
+        body = s3.Object(BENCH_BUCKET, job.get_output_path_from_objectkey(key)).get()['Body'].read()
+        if key.endswith('.jsonl'):
+            dest_content = [ json.loads(line)['dest_content'] for line in body.splitlines() if line.strip() ]
+        else:
+            dest_content = json.loads(body)['dest_content']
+        total += len(dest_content)
+        translated += sum(1 for item in dest_content if item is not None)
+    return total, translated
+
+def bench_translate(args, rng, timer):
+    job, s3, backend, bedrock, source_keys = setup_translate(args, rng, timer)
+
+    start = time.perf_counter()
+    with silenced(args.quiet):
+        failed_keys = job.translate_files(BENCH_BUCKET, source_keys)
+    elapsed = time.perf_counter() - start
+    total, translated = count_translated(job, s3, source_keys)
+
+    return {'segments': total, 'translated': translated, 'elapsed_s': round(elapsed, 3),
+            'segments_per_s': round(total / elapsed, 2), 'bedrock_calls': bedrock.calls,
+            'bedrock_throttled': bedrock.throttled, 'bedrock_errors': bedrock.errors, 'search_requests': backend.request_count,
+            'rate_limit_wait_s': round(job.bedrock_limiter.wait_seconds, 3), 'failed_files': len(failed_keys)}
+
+def write_fake_batch_output(s3, input_prefix, output_prefix, bedrock, error_rate, rng):
+    # what a bedrock batch inference job writes: one <input>.out per input file, with modelOutput or error per record
+    for (bucket, key), data in list(s3.objects.items()):
+        if not key.startswith(input_prefix) or not key.endswith('.jsonl'):
+            continue
+        lines = []
+        for line in data.decode('utf-8').splitlines():
+            record = json.loads(line)
+            if rng.random() < error_rate:
+                record['error'] = {'errorCode': 400, 'errorMessage': 'fake batch error'}
+            else:
+                request = record['modelInput']
+                answer = bedrock.build_answer(bedrock.prompt_text(request), request['messages'][-1]['content'])
+                record['modelOutput'] = {'content': [{'type': 'text', 'text': answer}], 'stop_reason': 'stop_sequence'}
+            lines.append(json.dumps(record, ensure_ascii=False))
+        s3.Object(bucket, f"{output_prefix}job-0/{key.split('/')[-1]}.out").put("\n".join(lines) + "\n")
+
+def bench_batch(args, rng, timer):
+    # both phases of --batch_phase with a fake batch output in between
+    job, s3, backend, bedrock, source_keys = setup_translate(args, rng, timer)
+    run_id = 'bench'
+    run_prefix = f"{job.BATCH_PREFIX}/{run_id}"
+
+    start = time.perf_counter()
+    with silenced(args.quiet):
+        job.prepare_batch_inference(BENCH_BUCKET, source_keys, run_id)
+    prepare_elapsed = time.perf_counter() - start
+    write_fake_batch_output(s3, f"{run_prefix}/input/", f"{run_prefix}/output/", bedrock, args.error_rate, rng)
+
+    start = time.perf_counter()
+    with silenced(args.quiet):
+        job.assemble_batch_translations(BENCH_BUCKET, run_id)
+    assemble_elapsed = time.perf_counter() - start
+    total, translated = count_translated(job, s3, source_keys)
+
+    records = sum(len(data.splitlines()) for (bucket, key), data in s3.objects.items() if key.startswith(f"{run_prefix}/input/"))
+    return {'segments': total, 'translated': translated, 'batch_records': records, 'prepare_s': round(prepare_elapsed, 3),
+            'assemble_s': round(assemble_elapsed, 3), 'fallback_bedrock_calls': bedrock.calls}
+
+def bench_ingest(args, rng, timer):
+    crosslingual, multilingual, terms = make_glossaries(args.terms, rng)
+    s3 = FakeS3Resource()
+    keys = ['kb/crosslingual_terminology.json', 'kb/multilingual_terminology.json']
+    s3.Object(BENCH_BUCKET, keys[0]).put(json.dumps(crosslingual, ensure_ascii=False))
+    s3.Object(BENCH_BUCKET, keys[1]).put(json.dumps(multilingual, ensure_ascii=False))
+    del crosslingual, multilingual, terms
+
+    job_args = ['--bucket', BENCH_BUCKET, '--object_key', ','.join(keys), '--AOS_ENDPOINT', 'benchmark',
+                '--REGION', 'us-east-1', '--AOS_INDEX', 'rag-data-index'] + shlex.split(args.job_args)
+    job = import_job('aos_write_job', job_args)
+
+    backend = FakeSearchBackend(latency_ms=args.search_latency_ms)
+    job.s3 = s3
+    job.bedrock = FakeBedrock(latency_ms=args.bedrock_latency_ms, seed=args.seed)
+    if job.embedder is not None and hasattr(job.embedder, 'bedrock_client'):
+        job.embedder.bedrock_client = job.bedrock
+    job.aos_client = backend
+    original_bulk = backend.bulk
+    backend.bulk = timer.wrap('bulk_request', original_bulk)
+    job.WriteVecIndexToAOS = timer.wrap('WriteVecIndexToAOS', job.WriteVecIndexToAOS)
+
+    start = time.perf_counter()
+    with silenced(args.quiet):
+        if job.REBUILD_INDEX:
+            # the live index of setup_knowledgebase.sh
+            backend.indices.create('rag-data-index', body={'settings': {'index': {'number_of_shards': '1', 'number_of_replicas': '0'}}})
+        job.ingest_files(BENCH_BUCKET, keys)
+    elapsed = time.perf_counter() - start
+
+    snapshot_key = get_latest_snapshot_key(job.GLOSSARY_SNAPSHOT_PREFIX)
+    snapshot = json.loads(s3.objects[(BENCH_BUCKET, snapshot_key)]) if (BENCH_BUCKET, snapshot_key) in s3.objects else None
+    return {'docs': len(backend.docs), 'elapsed_s': round(elapsed, 3), 'docs_per_s': round(len(backend.docs) / elapsed, 2),
+            'bulk_requests': backend.request_count, 'aliases': { alias: sorted(indices) for alias, indices in backend.indices.aliases.items() },
+            'glossary_snapshot': snapshot}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pipeline', type=str, default='translate', choices=['translate', 'batch', 'ingest'], help='pipeline to benchmark, one per process because the jobs read their arguments at import')
+    parser.add_argument('--terms', type=int, default=1000, help='number of synthetic glossary terms')
+    parser.add_argument('--segments', type=int, default=1000, help='segments per source file')
+    parser.add_argument('--files', type=int, default=1, help='number of source files')
+    parser.add_argument('--group_terms', type=int, default=50, help='crosslingual terms per indexed document of the translate pipeline if the job runs with --grouped_terms true')
+    parser.add_argument('--source_format', type=str, default='json', choices=['json', 'jsonl'], help='json: one src_content list per file, jsonl: one segment per line, streamed by the translate pipeline')
+    parser.add_argument('--bedrock_latency_ms', type=float, default=800, help='median latency of the fake bedrock')
+    parser.add_argument('--bedrock_latency_sigma', type=float, default=0.5, help='lognormal sigma of the fake bedrock latency')
+    parser.add_argument('--ms_per_output_token', type=float, default=0.0, help='extra fake bedrock latency per output token')
+    parser.add_argument('--throttle_rate', type=float, default=0.0, help='share of bedrock calls failing with ThrottlingException')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='share of bedrock calls failing with ServiceUnavailableException, and of failed records of the batch pipeline')
+    parser.add_argument('--search_latency_ms', type=float, default=5, help='latency of every fake search / bulk request')
+    parser.add_argument('--job_args', type=str, default='', help='extra job arguments, e.g. "--max_workers 16 --pack_segments 8"')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic data')
+    parser.add_argument('--output', type=str, default='', help='append the report as one json line to this file')
+    parser.add_argument('--verbose', dest='quiet', action='store_false', help='keep the job output')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    timer = StageTimer()
+    if args.pipeline == 'translate':
+        result = bench_translate(args, rng, timer)
+    elif args.pipeline == 'batch':
+        result = bench_batch(args, rng, timer)
+    else:
+        result = bench_ingest(args, rng, timer)
+
+    report = {'pipeline': args.pipeline, 'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'terms': args.terms, 'job_args': args.job_args,
+              'result': result, 'stages': timer.summary(), 'peak_rss_mb': peak_rss_mb()}
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report, ensure_ascii=False) + '\n')
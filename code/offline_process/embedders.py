@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# embedders shared by aos_write_job.py and rag_based_translate.py, shipped to glue as --extra-py-files
+import json
+import hashlib
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+class BedrockEmbedder():
+    model_id: str
+    dimension: int
+    bedrock_client: object
+    # requests in flight per embed_in_batches call, titan takes one text per request so a batch is many requests
+    max_concurrency = 8
+
+    def __init__(self, model_id: str, bedrock_client: object, dimension: int = 1024):
+        self.model_id = model_id
+        self.bedrock_client = bedrock_client
+        self.dimension = dimension
+
+    @property
+    def max_batch_size(self):
+        # cohere embeds up to 96 texts per request, titan one text per request
+        return 96 if self.model_id.startswith('cohere.') else 1
+
+    def embed(self, texts, input_type):
+        if self.model_id.startswith('cohere.'):
+            body = json.dumps({"texts": texts, "input_type": input_type, "truncate": "END"})
+            response = self.bedrock_client.invoke_model(body=body, modelId=self.model_id)
+            return json.loads(response['body'].read())['embeddings']
+
+        embeddings = []
+        for text in texts:
+            body = json.dumps({"inputText": text, "dimensions": self.dimension, "normalize": True})
+            response = self.bedrock_client.invoke_model(body=body, modelId=self.model_id)
+            embeddings.append(json.loads(response['body'].read())['embedding'])
+        return embeddings
+
+    def embed_documents(self, texts):
+        return self.embed(texts, "search_document")
+
+    def embed_queries(self, texts):
+        return self.embed(texts, "search_query")
+
+class HashingEmbedder():
+    # deterministic local stand-in, hashes character trigrams into a normalized vector so near-miss spellings stay close
+    dimension: int
+    max_batch_size = 1000
+    max_concurrency = 1
+
+    def __init__(self, dimension: int = 1024):
+        self.dimension = dimension
+
+    def embed_text(self, text):
+        vector = [0.0] * self.dimension
+        padded = f"  {text.casefold()}  "
+        for pos in range(len(padded) - 2):
+            digest = hashlib.md5(padded[pos:pos + 3].encode('utf-8')).digest()
+            bucket = int.from_bytes(digest[:4], 'little') % self.dimension
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [ value / norm for value in vector ]
+
+    def embed_documents(self, texts):
+        return [ self.embed_text(text) for text in texts ]
+
+    def embed_queries(self, texts):
+        return [ self.embed_text(text) for text in texts ]
+
+def get_embedder(embedding_model, bedrock_client, dimension=1024):
+    # '' disables embeddings, 'hashing' is the local stand-in, anything else is a bedrock embedding model id
+    if not embedding_model:
+        return None
+    if embedding_model == 'hashing':
+        return HashingEmbedder(dimension)
+    return BedrockEmbedder(embedding_model, bedrock_client, dimension)
+
+def embed_in_batches(embedder, texts, batch_size, input_type='document'):
+    batch_size = max(1, min(batch_size, embedder.max_batch_size))
+    embed_func = embedder.embed_documents if input_type == 'document' else embedder.embed_queries
+    batches = [ texts[start:start + batch_size] for start in range(0, len(texts), batch_size) ]
+    embeddings = []
+    if len(batches) <= 1 or embedder.max_concurrency <= 1:
+        for batch in batches:
+            embeddings.extend(embed_func(batch))
+        return embeddings
+    # map keeps the order of the batches
+    with ThreadPoolExecutor(max_workers=min(embedder.max_concurrency, len(batches))) as executor:
+        for batch_embeddings in executor.map(embed_func, batches):
+            embeddings.extend(batch_embeddings)
+    return embeddings
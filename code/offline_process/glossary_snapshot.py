@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# versioned terminology snapshot written by aos_write_job.py and memory-mapped by rag_based_translate.py,
+# shipped to glue as --extra-py-files
+#
+# layout: 8 byte magic, 4 byte header length, json header, then the sections below on 8 byte boundaries
+#   entries: 6 per term (doc_type, idx, category offset, category length, content offset, content length)
+#   hashes:  crc32 of every (normalized surface form, term) row, sorted
+#   rows:    3 per row in hash order (form offset, form length, term)
+#   strings: utf-8 blob the offsets point into
+import json
+import hashlib
+import mmap
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+
+SNAPSHOT_MAGIC = b'GLSNAP01'
+SNAPSHOT_DOC_TYPES = ['multilingual_terminology', 'crosslingual_terminology']
+
+def normalize_surface_form(text):
+    return text.strip().casefold()
+
+def get_surface_forms(doc_type, content):
+    # the strings a term is matched by, every language of a mapping or the term itself
+    if doc_type == 'multilingual_terminology':
+        forms = set(json.loads(content).values())
+    else:
+        forms = {content}
+    return { form for form in forms if form and form.strip() }
+
+def hash_surface_form(form):
+    return zlib.crc32(form.encode('utf-8'))
+
+def build_snapshot(terms):
+    # terms is an iterable of (doc_type, content, doc_category, idx), returns (version, bytes)
+    strings = bytearray()
+    string_offsets = {}
+
+    def add_string(text):
+        data = text.encode('utf-8')
+        if data not in string_offsets:
+            string_offsets[data] = len(strings)
+            strings.extend(data)
+        return string_offsets[data], len(data)
+
+    entries = array('I')
+    rows = []
+    entry_keys = set()
+    first_char_lengths = {}
+    # sorted so that the scan order of the index does not change the version
+    for doc_type, content, doc_category, idx in sorted(terms):
+        entry_key = (doc_type, content, doc_category)
+        if entry_key in entry_keys:
+            continue
+        entry_keys.add(entry_key)
+        entry_id = len(entry_keys) - 1
+        entries.extend([SNAPSHOT_DOC_TYPES.index(doc_type), idx, *add_string(doc_category), *add_string(content)])
+        for form in sorted(get_surface_forms(doc_type, content)):
+            form = normalize_surface_form(form)
+            rows.append((hash_surface_form(form), *add_string(form), entry_id))
+            first_char_lengths.setdefault(form[0], set()).add(len(form))
+
+    rows.sort()
+    hashes = array('I', [ row[0] for row in rows ])
+    row_values = array('I', [ value for row in rows for value in row[1:] ])
+    sections = [('entries', entries), ('hashes', hashes), ('rows', row_values)]
+    # the version only depends on the terms, an unchanged glossary keeps its version and cached file
+    version = hashlib.sha1(b''.join(section.tobytes() for _, section in sections) + bytes(strings)).hexdigest()[:16]
+
+    # section offsets are relative to the data, which starts at the first 8 byte boundary after the header
+    offsets = {}
+    offset = 0
+    for name, section in sections + [('strings', strings)]:
+        offset += -offset % 8
+        offsets[name] = offset
+        offset += len(section) * (section.itemsize if isinstance(section, array) else 1)
+    header = {'version': version, 'byteorder': sys.byteorder, 'entry_count': len(entry_keys), 'row_count': len(rows),
+              'doc_types': SNAPSHOT_DOC_TYPES, 'offsets': offsets,
+              # lengths of the surface forms per first character, the only substrings looked up while matching
+              'first_char_lengths': { ch: sorted(lengths) for ch, lengths in first_char_lengths.items() }}
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+
+    data = bytearray(SNAPSHOT_MAGIC)
+    data.extend(len(header_bytes).to_bytes(4, 'little'))
+    data.extend(header_bytes)
+    data_start = len(data) + (-len(data) % 8)
+    for name, section in sections + [('strings', strings)]:
+        data.extend(b'\0' * (data_start + offsets[name] - len(data)))
+        data.extend(section.tobytes() if isinstance(section, array) else section)
+    return version, bytes(data)
+
+class GlossarySnapshot():
+    # read-only view of a snapshot file, nothing but the header is parsed up front
+    version: str
+    entry_count: int
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a glossary snapshot")
+        header_length = int.from_bytes(self.buffer[len(SNAPSHOT_MAGIC):len(SNAPSHOT_MAGIC) + 4], 'little')
+        header_end = len(SNAPSHOT_MAGIC) + 4 + header_length
+        header = json.loads(self.buffer[len(SNAPSHOT_MAGIC) + 4:header_end])
+        data_start = header_end + (-header_end % 8)
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError(f"{path} was written on a {header['byteorder']} endian machine")
+        self.version = header['version']
+        self.entry_count = header['entry_count']
+        self.doc_types = header['doc_types']
+        self.first_char_lengths = header['first_char_lengths']
+        offsets = { name: data_start + offset for name, offset in header['offsets'].items() }
+        view = memoryview(self.buffer)
+        self.entries = view[offsets['entries']:offsets['entries'] + self.entry_count * 24].cast('I')
+        self.hashes = view[offsets['hashes']:offsets['hashes'] + header['row_count'] * 4].cast('I')
+        self.rows = view[offsets['rows']:offsets['rows'] + header['row_count'] * 12].cast('I')
+        self.strings_offset = offsets['strings']
+
+    def __len__(self):
+        return self.entry_count
+
+    def get_string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.buffer[start:start + length].decode('utf-8')
+
+    def __getitem__(self, entry_id):
+        # same shape as the GlossaryMatcher entries
+        doc_type, idx, category_offset, category_length, content_offset, content_length = self.entries[entry_id * 6:entry_id * 6 + 6]
+        return {'idx': idx, 'doc_category': self.get_string(category_offset, category_length),
+                'content': self.get_string(content_offset, content_length), 'doc_type': self.doc_types[doc_type]}
+
+    def lookup(self, form):
+        # ids of the terms with this normalized surface form
+        form_hash = hash_surface_form(form)
+        pos = bisect_left(self.hashes, form_hash)
+        entry_ids = []
+        while pos < len(self.hashes) and self.hashes[pos] == form_hash:
+            form_offset, form_length, entry_id = self.rows[pos * 3:pos * 3 + 3]
+            if self.get_string(form_offset, form_length) == form:
+                entry_ids.append(entry_id)
+            pos += 1
+        return entry_ids
+
+def get_snapshot_key(prefix, version):
+    return f"{prefix}/{version}.glsnap"
+
+def get_latest_snapshot_key(prefix):
+    # small json pointer to the current version, rewritten after the snapshot itself is uploaded
+    return f"{prefix}/latest.json"
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# job argument parsing shared by aos_write_job.py and rag_based_translate.py, shipped to glue as --extra-py-files
+try:
+    from awsglue.utils import getResolvedOptions
+except ImportError:
+    # outside of glue (local runs, benchmark.py) the job arguments are read from argv the same way
+    def getResolvedOptions(argv, names):
+        options = {}
+        for name in names:
+            if f'--{name}' not in argv:
+                raise RuntimeError(f"missing job argument --{name}")
+            options[name] = argv[argv.index(f'--{name}') + 1]
+        return options
+
+def get_optional_args(argv, defaults):
+    # getResolvedOptions fails on missing arguments, so only resolve the optional ones actually passed
+    passed_names = [ name for name in defaults if f'--{name}' in argv ]
+    options = dict(defaults)
+    if passed_names:
+        options.update(getResolvedOptions(argv, passed_names))
+    return options
@@ -5,7 +5,6 @@ from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth, he
 import boto3
 import random
 import json
-from awsglue.utils import getResolvedOptions
 import sys
 import hashlib
 import datetime
@@ -18,8 +17,37 @@ import numpy as np
 from urllib.parse import unquote
 from datetime import datetime
 import time
+import threading
+import sqlite3
+import unicodedata
+import math
+import uuid
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+from job_args import getResolvedOptions, get_optional_args
+from embedders import get_embedder, embed_in_batches
+from glossary_snapshot import GlossarySnapshot, get_surface_forms, get_snapshot_key, get_latest_snapshot_key
 
 args = getResolvedOptions(sys.argv, ['bucket', 'object_key', 'model_id', 'AOS_ENDPOINT', 'REGION', 'AOS_INDEX'])
+optional_args = get_optional_args(sys.argv, {'max_workers': '4', 'msearch_chunk_size': '50', 'retrieval_engine': 'aos', 'glossary_keys': '',
+                                                    'translation_memory': 'false', 'tm_s3_key': '', 'tm_local_path': '/tmp/translation_memory.sqlite', 'tm_max_mb': '512',
+                                                    'pack_segments': '1', 'pack_token_budget': '1500',
+                                                    'retrieval_mode': 'bm25', 'embedding_model': '', 'embedding_dimension': '1024', 'knn_candidates': '50', 'knn_min_score': '0.67',
+                                                    'lang_fields': 'false',
+                                                    'metrics_format': 'jsonl', 'metrics_s3_prefix': '', 'log_sample_rate': '0',
+                                                    'checkpoint': 'false', 'checkpoint_segments': '200', 'checkpoint_seconds': '60',
+                                                    'bedrock_rpm': '0', 'bedrock_tpm': '0', 'bedrock_max_attempts': '6',
+                                                    'retrieval_profile': 'default', 'max_files_in_flight': '2',
+                                                    'batch_phase': '', 'batch_prefix': 'batch_inference', 'batch_run_id': '', 'batch_role_arn': '',
+                                                    'batch_output_prefix': '', 'batch_records_per_file': '50000', 'batch_fallback': 'true',
+                                                    'glossary_token_budget': '0', 'prompt_caching': 'false',
+                                                    'fast_model_id': '', 'routing_rules': '', 'model_prices': '',
+                                                    'default_src_lang': 'EN', 'default_dest_lang': 'CN', 'stream_chunk_segments': '1000', 'stream_part_mb': '8',
+                                                    'glossary_snapshot_prefix': 'glossary_snapshot', 'glossary_snapshot_cache_dir': '/tmp/glossary_snapshot',
+                                                    'grouped_terms': 'false'})
 
 bucket = args['bucket']
 object_key = args['object_key']
@@ -28,37 +56,336 @@ model_id = args['model_id']
 AOS_ENDPOINT = args['AOS_ENDPOINT']
 AOS_INDEX = args['AOS_INDEX']
 REGION = args['REGION']
+# number of segments retrieved and translated in parallel, 1 means sequential
+MAX_WORKERS = max(1, int(optional_args['max_workers']))
+# number of source files translated at once, each with up to max_workers segments in flight
+MAX_FILES_IN_FLIGHT = max(1, int(optional_args['max_files_in_flight']))
+# number of segments sent in one _msearch request
+MSEARCH_CHUNK_SIZE = max(1, int(optional_args['msearch_chunk_size']))
+# aos: BM25 query per segment, local: exact matching against an in-memory glossary loaded once per job,
+# snapshot: the same exact matching against the memory-mapped glossary snapshot published by aos_write_job
+RETRIEVAL_ENGINE = optional_args['retrieval_engine']
+# S3 prefix of the snapshots, must be the glossary_snapshot_prefix of aos_write_job
+GLOSSARY_SNAPSHOT_PREFIX = optional_args['glossary_snapshot_prefix'].strip('/')
+# downloaded snapshots are kept here by version, a warm container skips the download
+GLOSSARY_SNAPSHOT_CACHE_DIR = optional_args['glossary_snapshot_cache_dir']
+# comma separated S3 keys of terminology json files for the local engine, the whole index is scrolled if empty
+GLOSSARY_KEYS = [ key for key in optional_args['glossary_keys'].split(',') if key ]
+# translation memory skips bedrock for segments already translated with the same glossary context
+TRANSLATION_MEMORY_ENABLED = optional_args['translation_memory'].lower() == 'true'
+# the sqlite file is downloaded from / uploaded to this key between runs if set
+TM_S3_KEY = optional_args['tm_s3_key']
+TM_LOCAL_PATH = optional_args['tm_local_path']
+TM_MAX_BYTES = int(optional_args['tm_max_mb']) * 1024 * 1024
+# up to pack_segments segments (and pack_token_budget estimated source tokens) are translated in one prompt, 1 disables packing
+PACK_SEGMENTS = max(1, int(optional_args['pack_segments']))
+PACK_TOKEN_BUDGET = int(optional_args['pack_token_budget'])
+# bm25: lexical match only, hybrid: bm25 and knn over the `embedding` field fused with reciprocal rank fusion
+RETRIEVAL_MODE = optional_args['retrieval_mode']
+# must be the embedding model used by aos_write_job to fill the index
+EMBEDDING_MODEL = optional_args['embedding_model']
+EMBEDDING_DIMENSION = int(optional_args['embedding_dimension'])
+KNN_CANDIDATES = int(optional_args['knn_candidates'])
+# knn always returns its k nearest terms and the weak ones are dropped. nmslib scores cosinesimil as 1 / (2 - cosine),
+# the default 0.67 keeps terms with a cosine of about 0.5 and more
+KNN_MIN_SCORE = float(optional_args['knn_min_score'])
+RRF_RANK_CONSTANT = 60
+# query multilingual terms on their per-language term_<lang> fields written by aos_write_job instead of the serialized content
+LANG_FIELDS = optional_args['lang_fields'].lower() == 'true'
+# the index holds crosslingual terms grouped by aos_write_job --group_terms, they are matched on `terms` and expanded from the highlights
+GROUPED_TERMS = optional_args['grouped_terms'].lower() == 'true'
+HIGHLIGHT_PATTERN = re.compile(r'<em>(.*?)</em>')
+# name of a preset in RETRIEVAL_PROFILES, or a json object overriding fields of the lean preset
+RETRIEVAL_PROFILE = optional_args['retrieval_profile']
+
+# per-file stage timings and counters, printed as one json line (jsonl) or as cloudwatch embedded metric format (emf), none disables them
+METRICS_FORMAT = optional_args['metrics_format']
+# the per-file metric lines of the job are also written to one jsonl object under this prefix if set
+METRICS_S3_PREFIX = optional_args['metrics_s3_prefix'].strip('/')
+# share of segments whose retrieved terms and prompts are printed, 0 disables the dumps
+LOG_SAMPLE_RATE = float(optional_args['log_sample_rate'])
+METRICS_NAMESPACE = 'RagBasedTranslate'
+# finished segments are saved under <dir>/translation/_checkpoint/<file>/ every checkpoint_segments segments or checkpoint_seconds,
+# a rerun of the same file only translates what is missing there
+CHECKPOINT_ENABLED = optional_args['checkpoint'].lower() == 'true'
+CHECKPOINT_SEGMENTS = max(1, int(optional_args['checkpoint_segments']))
+CHECKPOINT_SECONDS = float(optional_args['checkpoint_seconds'])
+# upper bounds of the adaptive bedrock rate limiter of this process, it halves the rates on throttling and slowly climbs back,
+# 0 sets no upper bound, the limiter then only limits after a throttle, starting from half the rate that was sent,
+# and stops limiting once it is back at that rate
+BEDROCK_RPM = float(optional_args['bedrock_rpm'])
+BEDROCK_TPM = float(optional_args['bedrock_tpm'])
+# attempts per call for throttling and transient errors, other errors fail the call right away
+BEDROCK_MAX_ATTEMPTS = max(1, int(optional_args['bedrock_max_attempts']))
+BACKOFF_BASE_SECONDS = 1
+# prepare: write the bedrock calls of all files as batch inference records, assemble: write translation/ from the batch output,
+# empty: translate synchronously with invoke_model
+BATCH_PHASE = optional_args['batch_phase']
+BATCH_PREFIX = optional_args['batch_prefix'].strip('/')
+# names the records and manifest of one batch under batch_prefix, generated by prepare and required by assemble
+BATCH_RUN_ID = optional_args['batch_run_id']
+# service role of the batch inference job, prepare only writes the records if empty
+BATCH_ROLE_ARN = optional_args['batch_role_arn']
+# where assemble reads the *.jsonl.out files, <batch_prefix>/<run_id>/output/ by default
+BATCH_OUTPUT_PREFIX = optional_args['batch_output_prefix'].strip('/')
+BATCH_RECORDS_PER_FILE = max(1, int(optional_args['batch_records_per_file']))
+# records missing from the batch output are translated with invoke_model by assemble
+BATCH_FALLBACK = optional_args['batch_fallback'].lower() == 'true'
+BACKOFF_MAX_SECONDS = 30
+# estimated tokens of the <glossaries> and <mapping_table> sections of one prompt, the lowest scoring lines are dropped beyond it, 0 means no limit
+GLOSSARY_TOKEN_BUDGET = int(optional_args['glossary_token_budget'])
+# marks the static instructions as a bedrock prompt cache checkpoint, only for models supporting prompt caching
+PROMPT_CACHING = optional_args['prompt_caching'].lower() == 'true'
+# cheaper model for the segments routed to 'fast' by routing_rules, empty sends every segment to model_id
+FAST_MODEL_ID = optional_args['fast_model_id']
+# json list of rules, the first rule matching a segment picks its route, DEFAULT_ROUTING_RULES if empty
+ROUTING_RULES = optional_args['routing_rules']
+# json object of model id => [usd per 1k input tokens, usd per 1k output tokens] for the per-route cost metrics
+MODEL_PRICES = json.loads(optional_args['model_prices'] or '{}')
+# .jsonl sources are streamed, one {"id", "src_lang", "dest_lang", "src_content"} object per line, id and languages are optional
+DEFAULT_SRC_LANG = optional_args['default_src_lang']
+DEFAULT_DEST_LANG = optional_args['default_dest_lang']
+# lines translated together, segments are only deduplicated and packed within one chunk
+STREAM_CHUNK_SEGMENTS = max(1, int(optional_args['stream_chunk_segments']))
+# the translated lines are uploaded in parts of this size, s3 needs at least 5 MB per part but the last
+STREAM_PART_BYTES = max(5, int(optional_args['stream_part_mb'])) * 1024 * 1024
+
+TERMINOLOGY_DOC_TYPES = ['multilingual_terminology', 'crosslingual_terminology']
 
 s3 = boto3.resource('s3', REGION)
-bedrock = boto3.client(service_name='bedrock-runtime', region_name=REGION)
-credentials = boto3.Session().get_credentials()
-awsauth = AWSV4SignerAuth(credentials, REGION)
+# botocore retries are off, invoke_bedrock retries itself so that the rate limiter sees every throttle
+bedrock = boto3.client(service_name='bedrock-runtime', region_name=REGION, config=Config(max_pool_connections=max(10, MAX_WORKERS * MAX_FILES_IN_FLIGHT), retries={'total_max_attempts': 1}))
+# the embedding calls of the hybrid retrieval do not go through the limiter and backoff of invoke_bedrock, botocore retries them
+embedding_bedrock = boto3.client(service_name='bedrock-runtime', region_name=REGION, config=Config(max_pool_connections=max(10, MAX_WORKERS * MAX_FILES_IN_FLIGHT), retries={'mode': 'standard', 'max_attempts': BEDROCK_MAX_ATTEMPTS}))
+
+def get_awsauth():
+    # resolved on first use so that importing this module needs no credentials
+    credentials = boto3.Session().get_credentials()
+    return AWSV4SignerAuth(credentials, REGION)
+
+class TranslateMetrics():
+    # wall time samples per stage and counters of one translated file, shared by the worker threads
+    HISTOGRAM_BOUNDS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+    def __init__(self, object_key=''):
+        self.object_key = object_key
+        self.started = time.perf_counter()
+        self.samples = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds * 1000)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    @staticmethod
+    def percentile(values, q):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)]
+
+    @classmethod
+    def histogram(cls, values):
+        # counts per upper bound in ms, the last bucket is everything above the largest bound
+        buckets = dict.fromkeys([ f"le_{bound}" for bound in cls.HISTOGRAM_BOUNDS_MS ] + ['le_inf'], 0)
+        for value in values:
+            bound = next((bound for bound in cls.HISTOGRAM_BOUNDS_MS if value <= bound), 'inf')
+            buckets[f"le_{bound}"] += 1
+        return buckets
+
+    def summary(self):
+        with self.lock:
+            samples = { stage: list(values) for stage, values in self.samples.items() if values }
+            counters = dict(self.counters)
+        stages = { stage: {'count': len(values),
+                           'total_ms': round(sum(values), 2),
+                           'p50_ms': round(self.percentile(values, 0.5), 2),
+                           'p90_ms': round(self.percentile(values, 0.9), 2),
+                           'p99_ms': round(self.percentile(values, 0.99), 2),
+                           'max_ms': round(max(values), 2),
+                           'histogram': self.histogram(values)}
+                   for stage, values in samples.items() }
+        return {'object_key': self.object_key, 'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'stages': stages, 'counters': counters}
+
+    def to_emf(self, summary):
+        # cloudwatch extracts the listed members as metrics from this log line, the histograms stay queryable in logs insights
+        metrics = {}
+        for stage, stats in summary['stages'].items():
+            for stat in ['count', 'total_ms', 'p50_ms', 'p99_ms']:
+                metrics[f"{stage}_{stat}"] = 'Count' if stat == 'count' else 'Milliseconds'
+        for name in summary['counters']:
+            metrics[name] = 'Count'
+
+        emf = {'_aws': {'Timestamp': int(time.time() * 1000),
+                        'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE,
+                                               'Dimensions': [['Pipeline']],
+                                               'Metrics': [ {'Name': name, 'Unit': unit} for name, unit in metrics.items() ]}]},
+               'Pipeline': 'translate', 'object_key': summary['object_key'],
+               'histograms': { stage: stats['histogram'] for stage, stats in summary['stages'].items() }}
+        for stage, stats in summary['stages'].items():
+            for stat in ['count', 'total_ms', 'p50_ms', 'p99_ms']:
+                emf[f"{stage}_{stat}"] = stats[stat]
+        emf.update(summary['counters'])
+        return emf
+
+    def emit(self):
+        summary = self.summary()
+        if METRICS_FORMAT == 'emf':
+            print(json.dumps(self.to_emf(summary), ensure_ascii=False))
+        elif METRICS_FORMAT == 'jsonl':
+            print(json.dumps(summary, ensure_ascii=False))
+        return summary
+
+def should_sample():
+    return LOG_SAMPLE_RATE > 0 and random.random() < LOG_SAMPLE_RATE
+
+# per-file metric summaries of this run, uploaded in __main__ when --metrics_s3_prefix is set
+metric_summaries = []
+
+def upload_metric_summaries(bucket, metrics_s3_prefix, summaries):
+    if not metrics_s3_prefix or not summaries:
+        return
+    metrics_key = f"{metrics_s3_prefix}/{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.jsonl"
+    body = "".join([ json.dumps(summary, ensure_ascii=False) + "\n" for summary in summaries ])
+    s3.Bucket(bucket).put_object(Key=metrics_key, Body=body.encode('utf-8'))
+    print(f"uploaded metrics of {len(summaries)} files to s3://{bucket}/{metrics_key}")
+
+RETRIEVAL_PROFILES = {
+    # the original query shape: full _source but the embedding, 10 hits, no cutoff
+    'default': {'source_includes': False, 'request_cache': False, 'min_score': 0, 'relative_score': 0,
+                'min_size': 10, 'max_size': 10, 'tokens_per_hit': 0, 'window_tokens': 0},
+    # only the used fields, cached, hits far below the best one dropped, fewer hits for short segments, long segments searched per sentence window
+    'lean': {'source_includes': True, 'request_cache': True, 'min_score': 0, 'relative_score': 0.3,
+             'min_size': 3, 'max_size': 10, 'tokens_per_hit': 20, 'window_tokens': 128},
+}
+
+SENTENCE_PATTERN = re.compile(r'[^.!?。！？;；\n]+[.!?。！？;；\n]*')
+
+class RetrievalProfile():
+    source_includes: bool
+    request_cache: bool
+    min_score: float
+    relative_score: float
+    min_size: int
+    max_size: int
+    tokens_per_hit: int
+    window_tokens: int
+
+    def __init__(self, source_includes=False, request_cache=False, min_score=0, relative_score=0, min_size=10, max_size=10, tokens_per_hit=0, window_tokens=0):
+        self.source_includes = source_includes
+        self.request_cache = request_cache
+        # absolute bm25 score below which aos drops a hit
+        self.min_score = min_score
+        # hits scoring below this share of the best hit of the same query are dropped
+        self.relative_score = relative_score
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        # one more hit per tokens_per_hit estimated tokens of the segment, 0 means always max_size
+        self.tokens_per_hit = tokens_per_hit
+        # segments longer than this are searched per window of whole sentences, 0 disables the split
+        self.window_tokens = window_tokens
+
+    @classmethod
+    def from_arg(cls, value):
+        if value.strip().startswith('{'):
+            return cls(**dict(RETRIEVAL_PROFILES['lean'], **json.loads(value)))
+        return cls(**RETRIEVAL_PROFILES[value])
+
+    def result_size(self, src_content):
+        if not self.tokens_per_hit:
+            return self.max_size
+        return min(self.max_size, self.min_size + estimate_tokens(src_content) // self.tokens_per_hit)
+
+    def source_fields(self, src_lang=None, dest_lang=None):
+        # the fields read by TerminologyRetriever.parse_terminology_hits
+        fields = ['idx', 'doc_category', 'content', 'doc_type']
+        fields += [ f"term_{lang}" for lang in [src_lang, dest_lang] if lang ]
+        return fields
+
+    def split_windows(self, src_content):
+        if not self.window_tokens or estimate_tokens(src_content) <= self.window_tokens:
+            return [src_content]
+        windows = []
+        current = ''
+        for sentence in SENTENCE_PATTERN.findall(src_content):
+            if current and estimate_tokens(current + sentence) > self.window_tokens:
+                windows.append(current)
+                current = ''
+            current += sentence
+        if current.strip():
+            windows.append(current)
+        return [ window for window in windows if window.strip() ] or [src_content]
 
 class TerminologyRetriever():
     aos_endpoint: str
     aos_index: str
     aos_client: object
+    embedder: object
+    profile: RetrievalProfile
     
-    def __init__(self, aos_endpoint: str, aos_index: str, aos_client: object):
+    def __init__(self, aos_endpoint: str, aos_index: str, aos_client: object, embedder: object = None, profile: RetrievalProfile = None):
         self.aos_endpoint = aos_endpoint
         self.aos_index = aos_index
         self.aos_client = aos_client
+        # hybrid retrieval if set
+        self.embedder = embedder
+        self.profile = profile or RetrievalProfile.from_arg(RETRIEVAL_PROFILE)
         
     @classmethod
     def from_endpoints(cls, aos_endpoint:str, aos_index:str):
         aos_client = OpenSearch(
                 hosts=[{'host': aos_endpoint, 'port': 443}],
-                http_auth = awsauth,
+                http_auth = get_awsauth(),
                 use_ssl=True,
                 verify_certs=True,
-                connection_class=RequestsHttpConnection
+                connection_class=RequestsHttpConnection,
+                pool_maxsize=max(10, MAX_WORKERS * MAX_FILES_IN_FLIGHT)
             )
 
+        embedder = None
+        if RETRIEVAL_MODE == 'hybrid':
+            embedder = get_embedder(EMBEDDING_MODEL, embedding_bedrock, EMBEDDING_DIMENSION)
+
         return cls(aos_endpoint=aos_endpoint,
                   aos_index=aos_index,
-                  aos_client=aos_client)
+                  aos_client=aos_client,
+                  embedder=embedder)
+
+    def build_lang_fields_query(self, src_content, doc_type, size, src_lang, dest_lang):
+        # only documents that have both languages can become a mapping line
+        query = {
+            "size": size,
+            "query": {
+                "bool": {
+                    "must": {
+                        "match": {
+                            f"term_{src_lang}": src_content
+                        }
+                    },
+                "filter": [
+                    {"term": {"doc_type": doc_type}},
+                    {"term": {"langs": dest_lang}}
+                    ]
+                }
+            }
+        }
+        return query
+
+    def build_terminology_query(self, src_content, doc_type, size=10, src_lang=None, dest_lang=None):
+        if LANG_FIELDS and doc_type == 'multilingual_terminology' and src_lang and dest_lang:
+            return self.build_lang_fields_query(src_content, doc_type, size, src_lang, dest_lang)
 
-    def search_aos_for_terminology(self, src_content, doc_type, size=10):
         query = {
             "size": size,
             "query": {
@@ -76,19 +403,532 @@ class TerminologyRetriever():
                 }
             }
         }
-        query_response = self.aos_client.search(
-            body=query,
-            index=self.aos_index
-        )
+        if GROUPED_TERMS and doc_type == 'crosslingual_terminology':
+            # grouped documents have an empty content, the matched values of their terms come back as highlights
+            query["query"]["bool"]["must"] = {"multi_match": {"query": src_content, "fields": ["content", "terms"]}}
+            query["highlight"] = {"fields": {"terms": {"number_of_fragments": 0}}, "pre_tags": ["<em>"], "post_tags": ["</em>"]}
+            query["_source"] = {"excludes": ["terms"]}
+        return query
+
+    def build_knn_query(self, embedding, doc_type, size=10):
+        # nmslib applies the filter after the approximate search, so ask for more candidates than needed
+        query = {
+            "size": size,
+            "min_score": KNN_MIN_SCORE,
+            "query": {
+                "bool": {
+                    "must": {
+                        "knn": {
+                            "embedding": {
+                                "vector": embedding,
+                                "k": max(size, KNN_CANDIDATES)
+                            }
+                        }
+                    },
+                "filter": {
+                    "term": {
+                        "doc_type": doc_type
+                        }
+                    }
+                }
+            }
+        }
+        return query
 
-        result_arr = [ {'idx':item['_source'].get('idx',0),'doc_category':item['_source']['doc_category'], 'content':item['_source']['content'], 'doc_type': item['_source']['doc_type'], 'score': item['_score']} for item in query_response["hits"]["hits"]]
+    def apply_profile(self, query, src_lang=None, dest_lang=None, min_score=0):
+        if self.profile.source_includes:
+            query["_source"] = {"includes": self.profile.source_fields(src_lang, dest_lang)}
+        else:
+            # the whole _source but the vector the ingest job writes for hybrid retrieval
+            query["_source"] = {"excludes": query.get("_source", {}).get("excludes", []) + ["embedding"]}
+        if min_score:
+            query["min_score"] = min_score
+        return query
+
+    def build_search_bodies(self, src_content, doc_type, size=None, embedding=None, src_lang=None, dest_lang=None):
+        # one bm25 body per sentence window, plus one knn body of the whole segment for hybrid retrieval
+        if size is None:
+            size = self.profile.result_size(src_content)
+        windows = self.profile.split_windows(src_content)
+        bodies = [ self.apply_profile(self.build_terminology_query(window, doc_type, self.profile.result_size(window) if len(windows) > 1 else size, src_lang, dest_lang), src_lang, dest_lang, self.profile.min_score) for window in windows ]
+        if embedding is not None:
+            # the knn query keeps its own knn_min_score on the cosine scale
+            bodies.append(self.apply_profile(self.build_knn_query(embedding, doc_type, size), src_lang, dest_lang))
+        return bodies
+
+    def parse_terminology_hits(self, query_response, src_lang=None, dest_lang=None):
+        # filter_path drops "hits" altogether when nothing matched
+        hits = self.expand_grouped_hits(query_response.get("hits", {}).get("hits", []))
+        result_arr = [ {'idx':item['_source'].get('idx',0),'doc_category':item['_source']['doc_category'], 'content':item['_source']['content'], 'doc_type': item['_source']['doc_type'], 'score': item['_score']} for item in hits]
+        # documents with per-language fields carry the pair directly, no need to parse the mapping json
+        for result, item in zip(result_arr, hits):
+            src_term = item['_source'].get(f"term_{src_lang}")
+            dest_term = item['_source'].get(f"term_{dest_lang}")
+            if src_term and dest_term:
+                result['src_term'] = src_term
+                result['dest_term'] = dest_term
+        if result_arr and self.profile.relative_score:
+            top_score = max(item['score'] for item in result_arr)
+            result_arr = [ item for item in result_arr if item['score'] >= top_score * self.profile.relative_score ]
         return result_arr
 
-def construct_translate_prompt(src_content, src_lang, dest_lang, retriever):
-    pe_template = """You are the world's most professional translation tool, proficient in professional translation between EN and CN..
+    @staticmethod
+    def expand_grouped_hits(hits):
+        # a grouped document becomes one hit per highlighted term, scored by the share of the term that matched
+        expanded = []
+        for item in hits:
+            highlights = item.get('highlight', {}).get('terms')
+            if highlights is None:
+                expanded.append(item)
+                continue
+            for highlight in highlights:
+                term = highlight.replace('<em>', '').replace('</em>', '')
+                matched_length = sum(len(match) for match in HIGHLIGHT_PATTERN.findall(highlight))
+                expanded.append(dict(item, _source=dict(item['_source'], content=term), _score=item['_score'] * matched_length / max(1, len(term))))
+        return expanded
+
+    def merge_window_hits(self, hits_list, size):
+        # a term found in several windows is kept once with its best score
+        merged = {}
+        for hits in hits_list:
+            for item in hits:
+                key = (item['doc_type'], item['content'], item['doc_category'])
+                if key not in merged or item['score'] > merged[key]['score']:
+                    merged[key] = item
+        return sorted(merged.values(), key=lambda item: item['score'], reverse=True)[:size]
+
+    def fuse_terminology_hits(self, hits_list, size=10):
+        # reciprocal rank fusion, bm25 and cosine scores are not on the same scale
+        fused = {}
+        for hits in hits_list:
+            for rank, item in enumerate(hits):
+                key = (item['doc_type'], item['content'], item['doc_category'])
+                if key not in fused:
+                    fused[key] = dict(item, score=0.0)
+                fused[key]['score'] += 1.0 / (RRF_RANK_CONSTANT + rank + 1)
+        result_arr = sorted(fused.values(), key=lambda item: item['score'], reverse=True)
+        return result_arr[:size]
+
+    def combine_responses(self, responses, size=10, src_lang=None, dest_lang=None, has_knn=False):
+        # responses are the bm25 windows followed by the knn response if has_knn
+        hits_list = [ self.parse_terminology_hits(response, src_lang, dest_lang) for response in responses ]
+        bm25_hits_list = hits_list[:-1] if has_knn else hits_list
+        # grouped documents can expand to more than size hits
+        bm25_hits = sorted(bm25_hits_list[0], key=lambda item: item['score'], reverse=True)[:size] if len(bm25_hits_list) == 1 else self.merge_window_hits(bm25_hits_list, size)
+        if not has_knn:
+            return bm25_hits
+        return self.fuse_terminology_hits([bm25_hits, hits_list[-1]], size)
+
+    def search_params(self, msearch=False):
+        # request_cache also caches searches with size > 0, filter_path trims the response to what is parsed,
+        # responses.status is in every msearch response so that one without hits is not dropped and the rest keep their position
+        params = {}
+        if self.profile.request_cache and not msearch:
+            params['request_cache'] = True
+        if self.profile.source_includes:
+            prefix = 'responses.' if msearch else ''
+            params['filter_path'] = [ f'{prefix}hits.hits._source', f'{prefix}hits.hits._score', f'{prefix}hits.hits.highlight' ] + ([ 'responses.error', 'responses.status' ] if msearch else [])
+        return params
+
+    def search_aos_for_terminology(self, src_content, doc_type, size=None, src_lang=None, dest_lang=None):
+        if size is None:
+            size = self.profile.result_size(src_content)
+        embedding = None
+        if self.embedder:
+            embedding = self.embedder.embed_queries([src_content])[0]
+
+        responses = [ self.aos_client.search(body=query, index=self.aos_index, **self.search_params()) for query in self.build_search_bodies(src_content, doc_type, size, embedding, src_lang, dest_lang) ]
+
+        return self.combine_responses(responses, size, src_lang, dest_lang, has_knn=embedding is not None)
+
+    def batch_search_aos_for_terminology(self, src_content_list, doc_types=TERMINOLOGY_DOC_TYPES, size=None, chunk_size=MSEARCH_CHUNK_SIZE, src_lang=None, dest_lang=None):
+        # one _msearch round trip per chunk instead of len(doc_types) searches per segment
+        # returns [{doc_type: hits}] in the order of src_content_list
+        embedding_list = [None] * len(src_content_list)
+        if self.embedder:
+            # query embeddings of the whole file in a few batched requests
+            embedding_list = embed_in_batches(self.embedder, src_content_list, len(src_content_list), input_type='query')
+
+        header = {"index": self.aos_index}
+        if self.profile.request_cache:
+            header["request_cache"] = True
+
+        result_list = []
+        for start in range(0, len(src_content_list), chunk_size):
+            chunk = src_content_list[start:start + chunk_size]
+            body = []
+            body_counts = []
+            for src_content, embedding in zip(chunk, embedding_list[start:start + chunk_size]):
+                for doc_type in doc_types:
+                    bodies = self.build_search_bodies(src_content, doc_type, size, embedding, src_lang, dest_lang)
+                    body_counts.append(len(bodies))
+                    for query in bodies:
+                        body.append(header)
+                        body.append(query)
+
+            responses = iter(self.aos_client.msearch(body=body, index=self.aos_index, **self.search_params(msearch=True))['responses'])
+            body_counts = iter(body_counts)
+
+            for src_content, embedding in zip(chunk, embedding_list[start:start + chunk_size]):
+                segment_size = size if size is not None else self.profile.result_size(src_content)
+                hits = {}
+                for doc_type in doc_types:
+                    doc_type_responses = [ next(responses) for _ in range(next(body_counts)) ]
+                    errors = [ response['error'] for response in doc_type_responses if 'error' in response ]
+                    if errors:
+                        print(f"msearch failed for {doc_type} of segment: {src_content}, error: {errors}")
+                        hits[doc_type] = self.search_aos_for_terminology(src_content, doc_type, size, src_lang, dest_lang)
+                    else:
+                        hits[doc_type] = self.combine_responses(doc_type_responses, segment_size, src_lang, dest_lang, has_knn=embedding is not None)
+                result_list.append(hits)
+
+        return result_list
+
+class AhoCorasickAutomaton():
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+    def add(self, pattern, value):
+        state = 0
+        for ch in pattern:
+            next_state = self.goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][ch] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            state = next_state
+        self.outputs[state].append((len(pattern), value))
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and ch not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(ch, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def iter_matches(self, text):
+        # yields (start, end, value) for every pattern occurrence, in a single pass over text
+        state = 0
+        for pos, ch in enumerate(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for length, value in self.outputs[state]:
+                yield pos + 1 - length, pos + 1, value
+
+class GlossaryMatcher():
+    # drop-in alternative to TerminologyRetriever, hits have the same shape but only exact (case-insensitive) matches are returned
+    entries: list
+    automaton: AhoCorasickAutomaton
+
+    def __init__(self):
+        self.entries = []
+        self.entry_keys = {}
+        self.automaton = AhoCorasickAutomaton()
+
+    @staticmethod
+    def normalize(text):
+        return text.casefold()
+
+    def add_term(self, doc_type, content, doc_category, idx=0):
+        entry_key = (doc_type, content, doc_category)
+        if entry_key in self.entry_keys:
+            return
+        entry_id = len(self.entries)
+        self.entry_keys[entry_key] = entry_id
+        self.entries.append({'idx': idx, 'doc_category': doc_category, 'content': content, 'doc_type': doc_type})
+
+        for surface_form in get_surface_forms(doc_type, content):
+            self.automaton.add(self.normalize(surface_form.strip()), entry_id)
+
+    def add_terminology_json(self, json_obj):
+        doc_type = json_obj["type"]
+        for idx, item in enumerate(json_obj["data"]):
+            if doc_type == 'multilingual_terminology':
+                self.add_term(doc_type, json.dumps(item["mapping"]), item["entity_type"], idx)
+            elif doc_type == 'crosslingual_terminology':
+                for term in item["terms"]:
+                    self.add_term(doc_type, term, item["entity_type"], idx)
+
+    @classmethod
+    def from_s3_json(cls, bucket, object_keys):
+        matcher = cls()
+        for key in object_keys:
+            matcher.add_terminology_json(json.loads(load_content_json_from_s3(bucket, key)))
+        matcher.automaton.build()
+        print(f"loaded {len(matcher.entries)} terms from {object_keys}")
+        return matcher
+
+    @classmethod
+    def from_index(cls, aos_client, aos_index):
+        matcher = cls()
+        query = {"query": {"terms": {"doc_type": TERMINOLOGY_DOC_TYPES}}}
+        for item in helpers.scan(aos_client, query=query, index=aos_index, _source=['idx', 'doc_type', 'content', 'doc_category', 'terms'], size=5000):
+            source = item['_source']
+            # a grouped document holds its terms in `terms`
+            for content in source.get('terms') or [source['content']]:
+                matcher.add_term(source['doc_type'], content, source['doc_category'], source.get('idx', 0))
+        matcher.automaton.build()
+        print(f"loaded {len(matcher.entries)} terms from index {aos_index}")
+        return matcher
+
+    @staticmethod
+    def is_word_char(ch):
+        return ch.isascii() and (ch.isalnum() or ch == '_')
+
+    def match(self, src_content):
+        # entry_id => longest matched surface form, latin terms must match on word boundaries
+        text = self.normalize(src_content)
+        matched = {}
+        for start, end, entry_id in self.automaton.iter_matches(text):
+            if start > 0 and self.is_word_char(text[start]) and self.is_word_char(text[start - 1]):
+                continue
+            if end < len(text) and self.is_word_char(text[end - 1]) and self.is_word_char(text[end]):
+                continue
+            matched[entry_id] = max(matched.get(entry_id, 0), end - start)
+        return matched
+
+    def search_aos_for_terminology(self, src_content, doc_type, size=10, src_lang=None, dest_lang=None):
+        matched = self.match(src_content)
+        result_arr = [ dict(self.entries[entry_id], score=float(length)) for entry_id, length in matched.items() if self.entries[entry_id]['doc_type'] == doc_type ]
+        result_arr.sort(key=lambda item: item['score'], reverse=True)
+        return result_arr[:size]
+
+    def batch_search_aos_for_terminology(self, src_content_list, doc_types=TERMINOLOGY_DOC_TYPES, size=10, chunk_size=MSEARCH_CHUNK_SIZE, src_lang=None, dest_lang=None):
+        return [ { doc_type: self.search_aos_for_terminology(src_content, doc_type, size) for doc_type in doc_types } for src_content in src_content_list ]
+
+class SnapshotGlossaryMatcher(GlossaryMatcher):
+    # matches like GlossaryMatcher, but looks the substrings of a segment up in a memory-mapped GlossarySnapshot
+    # instead of building an automaton of the whole glossary at startup
+    snapshot: GlossarySnapshot
+
+    def __init__(self, snapshot: GlossarySnapshot):
+        self.snapshot = snapshot
+        self.entries = snapshot
+
+    @classmethod
+    def from_s3(cls, bucket, prefix, cache_dir):
+        latest = json.loads(s3.Object(bucket, get_latest_snapshot_key(prefix)).get()['Body'].read())
+        local_path = os.path.join(cache_dir, f"{latest['version']}.glsnap")
+        if os.path.exists(local_path):
+            print(f"using cached glossary snapshot {local_path}")
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            # renamed into place once complete, so a concurrent job never maps a partial file
+            tmp_path = f"{local_path}.{uuid.uuid4().hex[:8]}.tmp"
+            s3.Bucket(bucket).download_file(get_snapshot_key(prefix, latest['version']), tmp_path)
+            os.replace(tmp_path, local_path)
+            print(f"downloaded glossary snapshot {latest['version']} to {local_path}")
+        matcher = cls(GlossarySnapshot(local_path))
+        print(f"loaded {len(matcher.entries)} terms from glossary snapshot {latest['version']}")
+        return matcher
+
+    def match(self, src_content):
+        # only substrings starting and ending on a word boundary with the length of a surface form of their first character are looked up
+        text = self.normalize(src_content)
+        matched = {}
+        for start in range(len(text)):
+            if start > 0 and self.is_word_char(text[start]) and self.is_word_char(text[start - 1]):
+                continue
+            for length in self.snapshot.first_char_lengths.get(text[start], []):
+                end = start + length
+                if end > len(text):
+                    break
+                if end < len(text) and self.is_word_char(text[end - 1]) and self.is_word_char(text[end]):
+                    continue
+                for entry_id in self.snapshot.lookup(text[start:end]):
+                    matched[entry_id] = max(matched.get(entry_id, 0), length)
+        return matched
+
+glossary_matcher = None
+glossary_matcher_lock = threading.Lock()
+
+def get_glossary_matcher():
+    # the glossary is loaded once per job and shared by all files
+    global glossary_matcher
+    with glossary_matcher_lock:
+        if glossary_matcher is None:
+            if RETRIEVAL_ENGINE == 'snapshot':
+                glossary_matcher = SnapshotGlossaryMatcher.from_s3(bucket, GLOSSARY_SNAPSHOT_PREFIX, GLOSSARY_SNAPSHOT_CACHE_DIR)
+            elif GLOSSARY_KEYS:
+                glossary_matcher = GlossaryMatcher.from_s3_json(bucket, GLOSSARY_KEYS)
+            else:
+                aos_client = TerminologyRetriever.from_endpoints(AOS_ENDPOINT, AOS_INDEX).aos_client
+                glossary_matcher = GlossaryMatcher.from_index(aos_client, AOS_INDEX)
+    return glossary_matcher
+
+# shared by all files of the job, one pooled aos client instead of one per file
+terminology_retriever = None
+terminology_retriever_lock = threading.Lock()
+
+def get_terminology_retriever():
+    global terminology_retriever
+    with terminology_retriever_lock:
+        if terminology_retriever is None:
+            if RETRIEVAL_ENGINE in ['local', 'snapshot']:
+                terminology_retriever = get_glossary_matcher()
+            else:
+                terminology_retriever = TerminologyRetriever.from_endpoints(AOS_ENDPOINT, AOS_INDEX)
+    return terminology_retriever
+
+def normalize_segment(content):
+    # collapse whitespace inside lines but keep the line structure of the segment
+    lines = unicodedata.normalize('NFC', content).strip().splitlines()
+    return '\n'.join(' '.join(line.split()) for line in lines)
+
+class TranslationMemory():
+    db_path: str
+    max_bytes: int
+
+    def __init__(self, db_path: str, max_bytes: int):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes_since_eviction = 0
+        # cleared when the s3 copy could not be read, uploading then would overwrite entries of other runs
+        self.upload_enabled = True
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tm (key TEXT PRIMARY KEY, translation TEXT, size INTEGER, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tm_last_used ON tm (last_used)")
+        self.conn.commit()
+
+    @classmethod
+    def from_s3(cls, bucket, s3_key, db_path, max_bytes):
+        upload_enabled = True
+        if s3_key:
+            try:
+                s3.Bucket(bucket).download_file(s3_key, db_path)
+                print(f"downloaded translation memory from s3://{bucket}/{s3_key}")
+            except Exception as e:
+                if not is_missing_s3_object(e):
+                    # the memory exists but could not be read, translate without it being overwritten at the end
+                    upload_enabled = False
+                    if os.path.exists(db_path):
+                        os.remove(db_path)
+                print(f"no translation memory downloaded from s3://{bucket}/{s3_key}, start with an empty one, Exception: {str(e)}")
+        translation_memory = cls(db_path, max_bytes)
+        translation_memory.upload_enabled = upload_enabled
+        return translation_memory
+
+    @staticmethod
+    def build_key(content, src_lang, dest_lang, model_id, glossary_context):
+        key_obj = [normalize_segment(content), src_lang, dest_lang, model_id, list(glossary_context)]
+        return hashlib.sha256(json.dumps(key_obj, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT translation FROM tm WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE tm SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, translation):
+        with self.lock:
+            size = len(key) + len(translation.encode('utf-8'))
+            self.conn.execute("INSERT OR REPLACE INTO tm VALUES (?, ?, ?, ?)", (key, translation, size, time.time()))
+            self.writes_since_eviction += 1
+            if self.writes_since_eviction >= 1000:
+                self.evict()
+
+    def evict(self):
+        # drop least recently used entries until the memory is back under 90% of max_bytes
+        self.writes_since_eviction = 0
+        total_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM tm").fetchone()[0]
+        if total_size <= self.max_bytes:
+            self.conn.commit()
+            return
+        target_size = int(self.max_bytes * 0.9)
+        evicted = 0
+        for key, size in self.conn.execute("SELECT key, size FROM tm ORDER BY last_used").fetchall():
+            if total_size <= target_size:
+                break
+            self.conn.execute("DELETE FROM tm WHERE key = ?", (key,))
+            total_size -= size
+            evicted += 1
+        self.conn.commit()
+        print(f"evicted {evicted} entries from translation memory")
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        print(f"translation memory: hits={self.hits}, misses={self.misses}, hit_rate={hit_rate:.2%}")
+
+    def merge_from_s3(self, bucket, s3_key):
+        # adds the entries other runs uploaded since this one downloaded the memory, returns False if the s3 copy could not be read
+        remote_path = f"{self.db_path}.remote"
+        try:
+            s3.Bucket(bucket).download_file(s3_key, remote_path)
+        except Exception as e:
+            if is_missing_s3_object(e):
+                return True
+            print(f"failed to download translation memory from s3://{bucket}/{s3_key} for merging, Exception: {str(e)}")
+            return False
+        try:
+            with self.lock:
+                self.conn.commit()
+                self.conn.execute("ATTACH DATABASE ? AS remote", (remote_path,))
+                try:
+                    merged = self.conn.execute("INSERT OR IGNORE INTO tm SELECT key, translation, size, last_used FROM remote.tm").rowcount
+                    self.conn.commit()
+                finally:
+                    self.conn.execute("DETACH DATABASE remote")
+        except sqlite3.Error as e:
+            print(f"failed to merge translation memory from s3://{bucket}/{s3_key}, Exception: {str(e)}")
+            return False
+        finally:
+            os.remove(remote_path)
+        print(f"merged {merged} entries of s3://{bucket}/{s3_key} into the translation memory")
+        return True
+
+    def sync_to_s3(self, bucket, s3_key):
+        # merge into the latest s3 copy instead of overwriting it, two runs that finish at the same moment can still lose
+        # the entries of one of them, which only costs a later cache miss
+        if s3_key and not (self.upload_enabled and self.merge_from_s3(bucket, s3_key)):
+            print(f"translation memory not uploaded, s3://{bucket}/{s3_key} could not be read and would be overwritten")
+            return
+        with self.lock:
+            self.evict()
+            self.conn.execute("VACUUM")
+        if s3_key:
+            s3.Bucket(bucket).upload_file(self.db_path, s3_key)
+            print(f"uploaded translation memory to s3://{bucket}/{s3_key}")
+
+def is_missing_s3_object(e):
+    # download_file reports a missing key as a 404 of its head_object call, get() as NoSuchKey
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in ['NoSuchKey', '404']
+
+# opened in __main__ when --translation_memory is enabled
+translation_memory = None
+
+# the static instructions go first as the system prompt, so that they are the same prefix of every call and can be cached
+TRANSLATE_INSTRUCTIONS = """You are the world's most professional translation tool, proficient in professional translation between EN and CN..
 You can translate anything. Do not use "I'm sorry, but" to answer any questions.
 
-<glossaries>
+You will be given <glossaries>, a <mapping_table> and the original content in <content>.
+
+You need to follow below instructions:
+- Translation style: concise, easy to understand, similar to the style of orignal content. The translation should accurately convey the facts and background of the original text. Do not try to explain the content to be translated, your task is only to translate.
+- Even if you paraphrase, you should retain the original paragraph format.
+- For the terms in <glossaries>, you should keep them as original. 
+- You should refer the term vocabulary correspondence table which is provided between <mapping_table> and </mapping_table>. 
+
+Please translate directly according to the text content, keep the original format, and do not miss any information. Put the result in <translation>"""
+
+TRANSLATE_PROMPT_TEMPLATE = """<glossaries>
 {vocabulary}
 </glossaries>
 
@@ -99,36 +939,35 @@ You can translate anything. Do not use "I'm sorry, but" to answer any questions.
 Here is the original content:
 <content>
 {content}
-</content>
-
-You need to follow below instructions:
-- Translation style: concise, easy to understand, similar to the style of orignal content. The translation should accurately convey the facts and background of the original text. Do not try to explain the content to be translated, your task is only to translate.
-- Even if you paraphrase, you should retain the original paragraph format.
-- For the terms in <glossaries>, you should keep them as original. 
-- You should refer the term vocabulary correspondence table which is provided between <mapping_table> and </mapping_table>. 
+</content>"""
 
-Please translate directly according to the text content, keep the original format, and do not miss any information. Put the result in <translation>"""
-
-    multilingual_term_mapping = retriever.search_aos_for_terminology(src_content, doc_type='multilingual_terminology')
-    print("multilingual_term_mapping")
-    print(multilingual_term_mapping)
-    crosslingual_terms = retriever.search_aos_for_terminology(src_content, doc_type='crosslingual_terminology')
-    print("crosslingual_terms")
-    print(crosslingual_terms)
+def retrieve_glossary_context(src_content, src_lang, dest_lang, retriever, prefetched_hits=None, metrics=None, verbose=False):
+    # prefetched_hits is one item of TerminologyRetriever.batch_search_aos_for_terminology
+    if metrics is None:
+        metrics = TranslateMetrics()
+    if prefetched_hits is not None:
+        multilingual_term_mapping = prefetched_hits['multilingual_terminology']
+        crosslingual_terms = prefetched_hits['crosslingual_terminology']
+    else:
+        with metrics.timer('search_aos_for_terminology'):
+            multilingual_term_mapping = retriever.search_aos_for_terminology(src_content, doc_type='multilingual_terminology', src_lang=src_lang, dest_lang=dest_lang)
+        with metrics.timer('search_aos_for_terminology'):
+            crosslingual_terms = retriever.search_aos_for_terminology(src_content, doc_type='crosslingual_terminology', src_lang=src_lang, dest_lang=dest_lang)
+    metrics.incr('multilingual_hits', len(multilingual_term_mapping))
+    metrics.incr('crosslingual_hits', len(crosslingual_terms))
+    if multilingual_term_mapping or crosslingual_terms:
+        metrics.incr('segments_with_hits')
+    if verbose:
+        print("multilingual_term_mapping")
+        print(multilingual_term_mapping)
+        print("crosslingual_terms")
+        print(crosslingual_terms)
 
     def build_glossaries(term, entity_type):
         obj = {"term":term, "entity_type":entity_type}
         return json.dumps(obj, ensure_ascii=False)
 
-    vocabulary_prompt_list = [ build_glossaries(item['content'], item['doc_category']) for item in crosslingual_terms ]
-    vocabulary_prompt = "\n".join(vocabulary_prompt_list)
-
     def build_mapping(src_lang, dest_lang, mapping_json, entity_type):
-        print(f"src_lang : {src_lang}")
-        print(f"dest_lang : {dest_lang}")
-        print(f"mapping : {mapping_json}")
-        print(f"entity_type : {entity_type}")
-
         obj = json.loads(mapping_json)
         src_term = obj.get(src_lang, None)
         target_term = obj.get(dest_lang, None)
@@ -138,12 +977,137 @@ Please translate directly according to the text content, keep the original forma
         else:
             return None
 
-    term_mapping_list = [ build_mapping(src_lang, dest_lang, item['content'], item['doc_category']) for item in multilingual_term_mapping ]
-    term_mapping_prompt = "\n".join([ item for item in term_mapping_list if item is not None ])
+    def build_mapping_from_pair(src_term, dest_term, entity_type):
+        if entity_type:
+            return f"[{entity_type}] {src_term}=>{dest_term}"
+        return None
+
+    vocabulary_lines = [ (item.get('score', 0), build_glossaries(item['content'], item['doc_category'])) for item in crosslingual_terms ]
+    term_mapping_lines = [ (item.get('score', 0), build_mapping_from_pair(item['src_term'], item['dest_term'], item['doc_category']) if 'src_term' in item else build_mapping(src_lang, dest_lang, item['content'], item['doc_category'])) for item in multilingual_term_mapping ]
+    vocabulary_lines, term_mapping_lines = select_glossary_lines(vocabulary_lines, term_mapping_lines, GLOSSARY_TOKEN_BUDGET, metrics)
+
+    return "\n".join(vocabulary_lines), "\n".join(term_mapping_lines)
 
-    prompt = pe_template.format(src_lang=src_lang, dest_lang=dest_lang, vocabulary=vocabulary_prompt, mappings=term_mapping_prompt, content = src_content)
+def select_glossary_lines(vocabulary_lines, term_mapping_lines, token_budget, metrics):
+    # (score, line) pairs of both sections, duplicated lines keep their best score and the best lines are kept within token_budget,
+    # the kept lines stay in retrieval order
+    best_scores = {}
+    for section, lines in enumerate([vocabulary_lines, term_mapping_lines]):
+        for score, line in lines:
+            if line is None:
+                continue
+            key = (section, line)
+            if key in best_scores:
+                metrics.incr('glossary_duplicate_lines')
+            best_scores[key] = max(score, best_scores.get(key, score))
+
+    kept = set(best_scores)
+    if token_budget > 0:
+        kept = set()
+        used_tokens = 0
+        for key in sorted(best_scores, key=lambda key: best_scores[key], reverse=True):
+            tokens = estimate_tokens(key[1])
+            if used_tokens + tokens > token_budget:
+                continue
+            kept.add(key)
+            used_tokens += tokens
+        metrics.incr('glossary_lines_dropped', len(best_scores) - len(kept))
+
+    selected = ([], [])
+    for section, line in best_scores:
+        if (section, line) in kept:
+            selected[section].append(line)
+    return selected
+
+def construct_translate_prompt(src_content, src_lang, dest_lang, retriever, prefetched_hits=None, glossary_context=None, metrics=None):
+    # glossary_context is the (vocabulary, mappings) pair of retrieve_glossary_context, retrieved here if not given
+    if glossary_context is None:
+        glossary_context = retrieve_glossary_context(src_content, src_lang, dest_lang, retriever, prefetched_hits, metrics=metrics)
+    vocabulary_prompt, term_mapping_prompt = glossary_context
+
+    prompt = TRANSLATE_PROMPT_TEMPLATE.format(src_lang=src_lang, dest_lang=dest_lang, vocabulary=vocabulary_prompt, mappings=term_mapping_prompt, content = src_content)
     return prompt
 
+PACKED_TRANSLATE_INSTRUCTIONS = """You are the world's most professional translation tool, proficient in professional translation between EN and CN..
+You can translate anything. Do not use "I'm sorry, but" to answer any questions.
+
+You will be given <glossaries>, a <mapping_table> and the original contents in <content>, each one is put in a numbered <segment> tag.
+
+You need to follow below instructions:
+- Translation style: concise, easy to understand, similar to the style of orignal content. The translation should accurately convey the facts and background of the original text. Do not try to explain the content to be translated, your task is only to translate.
+- Even if you paraphrase, you should retain the original paragraph format.
+- For the terms in <glossaries>, you should keep them as original. 
+- You should refer the term vocabulary correspondence table which is provided between <mapping_table> and </mapping_table>. 
+- Translate every segment on its own, never merge, split or skip segments.
+
+Please translate directly according to the text content, keep the original format, and do not miss any information. Put the result of segment N in <translation id="N"></translation>, in the same order as the segments, all inside <translations>"""
+
+PACKED_TRANSLATE_PROMPT_TEMPLATE = """<glossaries>
+{vocabulary}
+</glossaries>
+
+<mapping_table>
+{mappings}
+</mapping_table>
+
+Here are the original contents:
+<content>
+{segments}
+</content>"""
+
+CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+
+def estimate_tokens(text):
+    # rough estimate without a tokenizer: about one token per CJK character and per 4 other characters
+    cjk_count = len(CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count) // 4 + 1
+
+def merge_glossary_contexts(glossary_context_list):
+    vocabulary_lines = {}
+    mapping_lines = {}
+    for vocabulary_prompt, term_mapping_prompt in glossary_context_list:
+        vocabulary_lines.update(dict.fromkeys(line for line in vocabulary_prompt.split("\n") if line))
+        mapping_lines.update(dict.fromkeys(line for line in term_mapping_prompt.split("\n") if line))
+    return "\n".join(vocabulary_lines), "\n".join(mapping_lines)
+
+def construct_packed_translate_prompt(src_content_list, glossary_context_list):
+    vocabulary_prompt, term_mapping_prompt = merge_glossary_contexts(glossary_context_list)
+    segments = "\n".join([ f'<segment id="{seg_id}">\n{content}\n</segment>' for seg_id, content in enumerate(src_content_list) ])
+    return PACKED_TRANSLATE_PROMPT_TEMPLATE.format(vocabulary=vocabulary_prompt, mappings=term_mapping_prompt, segments=segments)
+
+def parse_packed_translation(text, segment_count):
+    # missing, duplicated or empty translations are left as None so that the caller retries them one by one
+    results = [None] * segment_count
+    if text is None:
+        return results
+    seen_ids = set()
+    for seg_id, translation in re.findall(r'<translation id="(\d+)">(.*?)</translation>', text, re.S):
+        seg_id = int(seg_id)
+        if seg_id >= segment_count:
+            continue
+        if seg_id in seen_ids:
+            results[seg_id] = None
+            continue
+        seen_ids.add(seg_id)
+        results[seg_id] = translation if translation.strip() else None
+    return results
+
+def build_packs(indices, src_content_list, pack_segments, pack_token_budget):
+    packs = []
+    current_pack = []
+    current_tokens = 0
+    for idx in indices:
+        tokens = estimate_tokens(src_content_list[idx])
+        if current_pack and (len(current_pack) >= pack_segments or current_tokens + tokens > pack_token_budget):
+            packs.append(current_pack)
+            current_pack = []
+            current_tokens = 0
+        current_pack.append(idx)
+        current_tokens += tokens
+    if current_pack:
+        packs.append(current_pack)
+    return packs
+
 def load_content_json_from_s3(bucket, object_key):
     if object_key.endswith('.json'):
         obj = s3.Object(bucket, object_key)
@@ -153,15 +1117,189 @@ def load_content_json_from_s3(bucket, object_key):
         
     return file_content
 
-def invoke_bedrock(model_id, prompt, max_tokens=4096, prefill_str='<translation>', stop=['</translation>']):
+THROTTLING_ERROR_CODES = ['ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException']
+# retried with backoff without lowering the rates, these are not caused by our own request rate
+TRANSIENT_ERROR_CODES = ['ServiceUnavailableException', 'ModelNotReadyException', 'ModelTimeoutException', 'InternalServerException', 'RequestTimeout']
+
+def classify_bedrock_error(e):
+    # throttle: retry and slow down the limiter, transient: retry, fatal: fail the call right away
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code', '')
+        if code in THROTTLING_ERROR_CODES:
+            return 'throttle'
+        if code in TRANSIENT_ERROR_CODES or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500:
+            return 'transient'
+        return 'fatal'
+    if isinstance(e, (BotoCoreError, json.JSONDecodeError, KeyError, IndexError)):
+        # connection errors, timeouts and truncated responses
+        return 'transient'
+    return 'fatal'
+
+def get_backoff_seconds(attempt):
+    # exponential backoff with full jitter, so workers throttled together do not retry together
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+class AdaptiveRateLimiter():
+    # token buckets on requests and tokens per minute shared by all workers of the process,
+    # the rates grow additively on success and are halved on throttling (AIMD), a rate of 0 is not limited
+    def __init__(self, requests_per_minute, tokens_per_minute, increase_fraction=0.02, decrease_factor=0.5, cooldown_seconds=5, burst_seconds=5):
+        self.max_rates = {'requests': requests_per_minute, 'tokens': tokens_per_minute}
+        self.min_rates = {'requests': 1, 'tokens': 1000}
+        self.rates = dict(self.max_rates)
+        # rates sent when the last throttle came, the soft upper bound of the kinds without a max rate
+        self.throttled_rates = {'requests': 0, 'tokens': 0}
+        self.increase_fraction = increase_fraction
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.burst_seconds = burst_seconds
+        self.levels = { kind: self.capacity(kind) for kind in self.rates }
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0
+        # (time, tokens) of the calls of the last minute, the rates are cut relative to what was really sent
+        self.history = deque()
+        self.throttles = 0
+        self.wait_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def enabled(self, kind):
+        return self.rates[kind] > 0
+
+    def capacity(self, kind):
+        return max(1, self.rates[kind] / 60 * self.burst_seconds)
+
+    def refill(self, now):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        for kind in self.rates:
+            self.levels[kind] = min(self.capacity(kind), self.levels[kind] + elapsed * self.rates[kind] / 60)
+        while self.history and self.history[0][0] < now - 60:
+            self.history.popleft()
+
+    def acquire(self, tokens):
+        # blocks until both buckets allow the call, returns the seconds waited
+        costs = {'requests': 1, 'tokens': tokens}
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                # a call larger than the bucket only waits for a full bucket and leaves it in debt
+                waits = [ (min(costs[kind], self.capacity(kind)) - self.levels[kind]) * 60 / self.rates[kind]
+                          for kind in self.rates if self.enabled(kind) ]
+                wait = max(waits + [0])
+                if wait <= 0:
+                    for kind in self.rates:
+                        self.levels[kind] -= costs[kind]
+                    self.history.append((now, tokens))
+                    self.wait_seconds += waited
+                    return waited
+            wait = min(wait, 1.0)
+            time.sleep(wait)
+            waited += wait
 
+    def settle(self, estimated_tokens, actual_tokens):
+        # the token bucket was charged with an estimate before the call
+        with self.lock:
+            self.levels['tokens'] -= actual_tokens - estimated_tokens
+
+    def on_success(self):
+        with self.lock:
+            for kind in self.rates:
+                if not self.enabled(kind):
+                    continue
+                if self.max_rates[kind] > 0:
+                    self.rates[kind] = min(self.max_rates[kind], self.rates[kind] + self.max_rates[kind] * self.increase_fraction)
+                else:
+                    self.rates[kind] += self.throttled_rates[kind] * self.increase_fraction
+                    if self.rates[kind] >= self.throttled_rates[kind]:
+                        # recovered without a throttle, not limited again until the next one
+                        self.rates[kind] = 0
+
+    def on_throttle(self):
+        with self.lock:
+            self.throttles += 1
+            now = time.monotonic()
+            # a burst of throttles seen by several workers at once is one congestion signal
+            if now - self.last_decrease < self.cooldown_seconds:
+                return
+            self.last_decrease = now
+            self.refill(now)
+            # per minute rates actually sent over the calls of the last minute, idle time before the first call does not count
+            window = min(60, max(1, now - self.history[0][0])) if self.history else 60
+            sent = {'requests': len(self.history) * 60 / window, 'tokens': sum(tokens for _, tokens in self.history) * 60 / window}
+            for kind in self.rates:
+                if self.max_rates[kind] <= 0:
+                    self.throttled_rates[kind] = max(self.min_rates[kind], sent[kind] or self.rates[kind])
+                    if not self.enabled(kind):
+                        self.rates[kind] = self.throttled_rates[kind]
+                        self.levels[kind] = 0
+                self.rates[kind] = max(self.min_rates[kind], min(self.rates[kind], sent[kind] or self.rates[kind]) * self.decrease_factor)
+                self.levels[kind] = min(self.levels[kind], 0)
+            print(f"bedrock throttled, rate limit lowered to {self.rates['requests']:.0f} requests / {self.rates['tokens']:.0f} tokens per minute")
+
+    def report(self):
+        rates = ' / '.join(f"{self.rates[kind]:.0f} {kind}" if self.enabled(kind) else f"unlimited {kind}" for kind in self.rates)
+        print(f"bedrock rate limiter: throttles={self.throttles}, wait_seconds={self.wait_seconds:.1f}, rates={rates} per minute")
+
+# hits are the glossary and mapping lines of the segment prompt, tokens the estimated tokens of the segment,
+# lang_pairs like "EN-CN", a rule matches if all of its conditions hold
+DEFAULT_ROUTING_RULES = [
+    # nothing to keep or map, the fast model only has to translate
+    {'route': 'fast', 'max_hits': 0, 'max_tokens': 200},
+    # short chat lines with a few terms
+    {'route': 'fast', 'max_hits': 2, 'max_tokens': 30},
+]
+
+class ModelRouter():
+    strong_model_id: str
+    fast_model_id: str
+    rules: list
+
+    def __init__(self, strong_model_id, fast_model_id='', rules=None):
+        self.strong_model_id = strong_model_id
+        self.fast_model_id = fast_model_id
+        self.rules = DEFAULT_ROUTING_RULES if rules is None else rules
+        for rule in self.rules:
+            if rule.get('route') not in ['fast', 'strong']:
+                raise ValueError(f"routing rule {rule} needs a route of fast or strong")
+
+    @classmethod
+    def from_arg(cls, strong_model_id, fast_model_id, value):
+        return cls(strong_model_id, fast_model_id, json.loads(value) if value.strip() else None)
+
+    @staticmethod
+    def match(rule, tokens, hits, lang_pair):
+        if tokens < rule.get('min_tokens', 0) or tokens > rule.get('max_tokens', tokens):
+            return False
+        if hits < rule.get('min_hits', 0) or hits > rule.get('max_hits', hits):
+            return False
+        lang_pairs = [ pair.upper() for pair in rule.get('lang_pairs', []) ]
+        return not lang_pairs or lang_pair in lang_pairs
+
+    def route(self, src_content, src_lang, dest_lang, glossary_context):
+        if not self.fast_model_id:
+            return 'strong'
+        tokens = estimate_tokens(src_content)
+        hits = sum(len([ line for line in section.split("\n") if line ]) for section in glossary_context)
+        lang_pair = f"{src_lang}-{dest_lang}".upper()
+        for rule in self.rules:
+            if self.match(rule, tokens, hits, lang_pair):
+                return rule['route']
+        return 'strong'
+
+    def model_id(self, route):
+        return self.fast_model_id if route == 'fast' else self.strong_model_id
+
+bedrock_limiter = AdaptiveRateLimiter(BEDROCK_RPM, BEDROCK_TPM)
+
+def build_bedrock_request(prompt, max_tokens=4096, prefill_str='<translation>', stop=['</translation>'], system=None):
+    # system holds the static instructions, it is the same for every call so bedrock can cache it as a prompt prefix
     messages = [
         {"role": "user", "content": prompt},
         {"role": "assistant", "content": prefill_str}
     ]
 
-    body = json.dumps(
-            {
+    request = {
                 "anthropic_version": "bedrock-2023-05-31",
                 "messages": messages,
                 "max_tokens": max_tokens,
@@ -170,27 +1308,75 @@ def invoke_bedrock(model_id, prompt, max_tokens=4096, prefill_str='<translation>
                 "top_k": 50,
                 "temperature": 0.1
             }
-        )
-    max_retries = 2
-    retry_count = 0
+    if system:
+        system_block = {"type": "text", "text": system}
+        if PROMPT_CACHING:
+            system_block["cache_control"] = {"type": "ephemeral"}
+        request["system"] = [system_block]
+    return request
+
+def invoke_bedrock(model_id, prompt, max_tokens=4096, prefill_str='<translation>', stop=['</translation>'], metrics=None, system=None, route=None):
+    # route names the ModelRouter route of the call, its tokens and cost are then also counted per route
+    if metrics is None:
+        metrics = TranslateMetrics()
 
-    while retry_count < max_retries:
+    body = json.dumps(build_bedrock_request(prompt, max_tokens, prefill_str, stop, system))
+    prompt_tokens = estimate_tokens(prompt)
+    system_tokens = estimate_tokens(system) if system else 0
+    metrics.incr('prompt_tokens_estimated', prompt_tokens)
+    metrics.incr('system_tokens_estimated', system_tokens)
+    # the output is about as long as the input for translations
+    estimated_tokens = prompt_tokens * 2 + system_tokens
+
+    for attempt in range(BEDROCK_MAX_ATTEMPTS):
+        wait_seconds = bedrock_limiter.acquire(estimated_tokens)
+        metrics.record('rate_limit_wait', wait_seconds)
         try:
-            response = bedrock.invoke_model(body=body, modelId=model_id)
-            rep_obj = json.loads(response['body'].read().decode('utf8'))
-            return rep_obj['content'][0]['text']
+            metrics.incr('bedrock_calls')
+            with metrics.timer('invoke_bedrock'):
+                response = bedrock.invoke_model(body=body, modelId=model_id)
+                rep_obj = json.loads(response['body'].read().decode('utf8'))
+            usage = rep_obj.get('usage', {})
+            metrics.incr('input_tokens', usage.get('input_tokens', 0))
+            metrics.incr('output_tokens', usage.get('output_tokens', 0))
+            # only reported by models with prompt caching, input_tokens then excludes the cached prefix
+            metrics.incr('cache_read_input_tokens', usage.get('cache_read_input_tokens', 0))
+            metrics.incr('cache_write_input_tokens', usage.get('cache_creation_input_tokens', 0))
+            if route:
+                metrics.incr(f'route_{route}_calls')
+                metrics.incr(f'route_{route}_input_tokens', usage.get('input_tokens', 0))
+                metrics.incr(f'route_{route}_output_tokens', usage.get('output_tokens', 0))
+                if model_id in MODEL_PRICES:
+                    input_price, output_price = MODEL_PRICES[model_id]
+                    metrics.incr(f'route_{route}_cost_usd', (usage.get('input_tokens', 0) * input_price + usage.get('output_tokens', 0) * output_price) / 1000)
+            if rep_obj.get('stop_reason') == 'max_tokens':
+                metrics.incr('max_tokens_stops')
+            text = rep_obj['content'][0]['text']
         except Exception as e:
-            retry_count += 1
-            print(f"Attempt {retry_count} failed: {e}")
-            if retry_count == max_retries:
-                print("Maximum retries reached. Operation failed.")
-            else:
-                print(f"Retrying in 1 seconds... (attempt {retry_count + 1})")
-                time.sleep(1)
+            error_type = classify_bedrock_error(e)
+            print(f"Attempt {attempt + 1} failed ({error_type}): {e}")
+            if error_type == 'throttle':
+                metrics.incr('bedrock_throttles')
+                bedrock_limiter.on_throttle()
+            if error_type == 'fatal' or attempt + 1 == BEDROCK_MAX_ATTEMPTS:
+                metrics.incr('bedrock_failures')
+                print("Maximum retries reached or error is not retryable. Operation failed.")
+                return None
+            metrics.incr('bedrock_retries')
+            backoff_seconds = get_backoff_seconds(attempt)
+            metrics.record('backoff_wait', backoff_seconds)
+            time.sleep(backoff_seconds)
+            continue
+
+        bedrock_limiter.settle(estimated_tokens, usage.get('input_tokens', 0) + usage.get('output_tokens', 0) or estimated_tokens)
+        bedrock_limiter.on_success()
+        return text
 
     return None
 
-def translate_by_llm(file_content, model_id):
+def translate_by_llm(file_content, model_id, metrics=None, checkpoint=None, batch_requests=None):
+    # with a batch_requests list the bedrock calls are appended to it instead of being made,
+    # dest_content then only holds the checkpointed and translation memory results
     # {
     #     "src_lang" : "EN",
     #     "dest_lang" : "CN",
@@ -200,23 +1386,172 @@ def translate_by_llm(file_content, model_id):
     #     ]
     # }
     json_obj = json.loads(file_content)
-    src_lang = json_obj['src_lang']
-    dest_lang = json_obj['dest_lang']
-    src_content_list = json_obj['src_content']
+    json_obj["dest_content"] = translate_segments(json_obj['src_content'], json_obj['src_lang'], json_obj['dest_lang'], model_id,
+                                                  metrics=metrics, checkpoint=checkpoint, batch_requests=batch_requests)
+    if translation_memory:
+        translation_memory.report()
+    return json_obj
 
-    retriever = TerminologyRetriever.from_endpoints(AOS_ENDPOINT, AOS_INDEX)
+def translate_segments(src_content_list, src_lang, dest_lang, model_id, metrics=None, checkpoint=None, batch_requests=None):
+    # returns the translations of src_content_list, None for the segments that failed or are left to batch_requests
+    if metrics is None:
+        metrics = TranslateMetrics()
 
-    dest_content_list = []
+    # identical segments are retrieved and translated only once per file
+    # normalized segment => first original occurrence, which is the one translated
+    unique_contents = {}
     for content in src_content_list:
-        prompt = construct_translate_prompt(content, src_lang, dest_lang, retriever)
-        print("prompt:")
-        print(prompt)
+        unique_contents.setdefault(normalize_segment(content), content)
+    unique_content_list = list(unique_contents.values())
+    print(f"{len(src_content_list)} segments, {len(unique_content_list)} unique")
+    metrics.incr('segments', len(src_content_list))
+    metrics.incr('unique_segments', len(unique_content_list))
+    # retrieved terms and prompts of the sampled segments are printed
+    sampled_indices = set(idx for idx in range(len(unique_content_list)) if should_sample())
 
-        result = invoke_bedrock(model_id, prompt)
-        dest_content_list.append(result)
+    # segments finished by an earlier run of this file are neither retrieved nor translated again
+    checkpoint_keys = [ TranslationCheckpoint.build_key(key, src_lang, dest_lang, model_id) for key in unique_contents.keys() ]
+    checkpointed_results = [ checkpoint.get(key) if checkpoint else None for key in checkpoint_keys ]
+    if checkpoint:
+        metrics.incr('checkpointed_segments', len(checkpointed_results) - checkpointed_results.count(None))
+    todo_indices = [ idx for idx, result in enumerate(checkpointed_results) if result is None ]
+    todo_content_list = [ unique_content_list[idx] for idx in todo_indices ]
 
-    json_obj["dest_content"] = dest_content_list
-    return json_obj
+    retriever = get_terminology_retriever()
+    # a batch inference job runs one model, so batch requests are not routed
+    router = ModelRouter.from_arg(model_id, FAST_MODEL_ID if batch_requests is None else '', ROUTING_RULES)
+
+    try:
+        with metrics.timer('batch_search_aos_for_terminology'):
+            prefetched_hits_list = retriever.batch_search_aos_for_terminology(todo_content_list, src_lang=src_lang, dest_lang=dest_lang)
+    except Exception as e:
+        # fall back to one search per segment and doc_type
+        print(f"batch terminology retrieval failed, Exception: {str(e)}")
+        prefetched_hits_list = [None] * len(todo_content_list)
+
+    def prepare_segment(idx, prefetched_hits):
+        # returns (glossary_context, tm_key, cached_result, route)
+        content = unique_content_list[idx]
+        try:
+            glossary_context = retrieve_glossary_context(content, src_lang, dest_lang, retriever, prefetched_hits, metrics=metrics, verbose=idx in sampled_indices)
+        except Exception as e:
+            metrics.incr('retrieval_failures')
+            print(f"failed to retrieve terminology for segment: {content}, Exception: {str(e)}")
+            return None, None, None, None
+
+        route = router.route(content, src_lang, dest_lang, glossary_context)
+        if translation_memory:
+            tm_key = TranslationMemory.build_key(content, src_lang, dest_lang, router.model_id(route), glossary_context)
+            cached_result = translation_memory.get(tm_key)
+            metrics.incr('tm_hits' if cached_result is not None else 'tm_misses')
+            return glossary_context, tm_key, cached_result, route
+        return glossary_context, None, None, route
+
+    def translate_segment(idx, route='strong'):
+        # returns (translation, route of the model that produced it)
+        content = unique_content_list[idx]
+        try:
+            with metrics.timer('construct_translate_prompt'):
+                prompt = construct_translate_prompt(content, src_lang, dest_lang, retriever, glossary_context=glossary_context_list[idx], metrics=metrics)
+            if idx in sampled_indices:
+                print("prompt:")
+                print(prompt)
+
+            with metrics.timer(f'route_{route}_invoke_bedrock'):
+                text = invoke_bedrock(router.model_id(route), prompt, metrics=metrics, system=TRANSLATE_INSTRUCTIONS, route=route)
+        except Exception as e:
+            # one broken segment should not stop the rest of the file
+            print(f"failed to translate segment: {content}, Exception: {str(e)}")
+            text = None
+        if text is None and route == 'fast':
+            metrics.incr('route_fast_fallbacks')
+            return translate_segment(idx, 'strong')
+        return text, route
+
+    def translate_pack(pack, route='strong'):
+        # returns a (translation, route) pair per segment of the pack
+        if len(pack) == 1:
+            return [translate_segment(pack[0], route)]
+
+        pack_content_list = [ unique_content_list[idx] for idx in pack ]
+        try:
+            with metrics.timer('construct_translate_prompt'):
+                prompt = construct_packed_translate_prompt(pack_content_list, [ glossary_context_list[idx] for idx in pack ])
+            if sampled_indices.intersection(pack):
+                print("prompt:")
+                print(prompt)
+
+            with metrics.timer(f'route_{route}_invoke_bedrock'):
+                text = invoke_bedrock(router.model_id(route), prompt, prefill_str='<translations>', stop=['</translations>'], metrics=metrics,
+                                      system=PACKED_TRANSLATE_INSTRUCTIONS, route=route)
+            results = parse_packed_translation(text, len(pack))
+        except Exception as e:
+            print(f"failed to translate packed segments: {pack_content_list}, Exception: {str(e)}")
+            results = [None] * len(pack)
+
+        retry_count = results.count(None)
+        if retry_count:
+            metrics.incr('pack_segment_retries', retry_count)
+            print(f"{retry_count} of {len(pack)} packed segments are missing, retry them one by one")
+        return [ (result, route) if result is not None else translate_segment(idx, route) for idx, result in zip(pack, results) ]
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        prepared_list = [(None, None, None, None)] * len(unique_content_list)
+        for idx, item in zip(todo_indices, executor.map(prepare_segment, todo_indices, prefetched_hits_list)):
+            prepared_list[idx] = item
+        glossary_context_list = [ item[0] for item in prepared_list ]
+        unique_result_list = [ item[2] for item in prepared_list ]
+        for idx, result in enumerate(checkpointed_results):
+            if result is not None:
+                unique_result_list[idx] = result
+            elif checkpoint and unique_result_list[idx] is not None:
+                # translation memory hits are checkpointed too, the memory may be evicted before the rerun
+                checkpoint.add(checkpoint_keys[idx], unique_result_list[idx])
+
+        # segments whose retrieval failed are left untranslated, like a failed bedrock call
+        pending_indices = [ idx for idx in todo_indices if prepared_list[idx][0] is not None and prepared_list[idx][2] is None ]
+        # segments are only packed with segments of the same route
+        packs = []
+        for route in ['fast', 'strong']:
+            route_indices = [ idx for idx in pending_indices if prepared_list[idx][3] == route ]
+            metrics.incr(f'route_{route}_segments', len(route_indices))
+            packs.extend((pack, route) for pack in build_packs(route_indices, unique_content_list, PACK_SEGMENTS, PACK_TOKEN_BUDGET))
+        print(f"{len(pending_indices)} segments to translate in {len(packs)} bedrock calls")
+
+        if batch_requests is not None:
+            segment_positions = defaultdict(list)
+            for pos, content in enumerate(src_content_list):
+                segment_positions[normalize_segment(content)].append(pos)
+            unique_keys = list(unique_contents.keys())
+            for pack, route in packs:
+                with metrics.timer('construct_translate_prompt'):
+                    if len(pack) == 1:
+                        prompt = construct_translate_prompt(unique_content_list[pack[0]], src_lang, dest_lang, retriever, glossary_context=glossary_context_list[pack[0]], metrics=metrics)
+                        request = build_bedrock_request(prompt, system=TRANSLATE_INSTRUCTIONS)
+                    else:
+                        prompt = construct_packed_translate_prompt([ unique_content_list[idx] for idx in pack ], [ glossary_context_list[idx] for idx in pack ])
+                        request = build_bedrock_request(prompt, prefill_str='<translations>', stop=['</translations>'], system=PACKED_TRANSLATE_INSTRUCTIONS)
+                batch_requests.append({'model_input': request,
+                                       'segments': [ {'positions': segment_positions[unique_keys[idx]], 'tm_key': prepared_list[idx][1]} for idx in pack ]})
+            packs = []
+
+        # finished packs are checkpointed in completion order, a slow pack does not hold back the others
+        futures = { executor.submit(translate_pack, pack, route): pack for pack, route in packs }
+        for future in as_completed(futures):
+            for idx, (result, result_route) in zip(futures[future], future.result()):
+                unique_result_list[idx] = result
+                if translation_memory and result is not None:
+                    # a fast segment that fell back to the strong model is stored under the strong model's key
+                    tm_key = prepared_list[idx][1] if result_route == prepared_list[idx][3] else \
+                        TranslationMemory.build_key(unique_content_list[idx], src_lang, dest_lang, router.model_id(result_route), glossary_context_list[idx])
+                    translation_memory.put(tm_key, result)
+                if checkpoint and result is not None:
+                    checkpoint.add(checkpoint_keys[idx], result)
+
+    unique_results = dict(zip(unique_contents.keys(), unique_result_list))
+    dest_content = [ unique_results[normalize_segment(content)] for content in src_content_list ]
+    metrics.incr('untranslated_segments', dest_content.count(None))
+    return dest_content
 
 def get_output_path_from_objectkey(object_key):
     paths = object_key.split('/')
@@ -224,26 +1559,478 @@ def get_output_path_from_objectkey(object_key):
     file_name = paths[-1]
     return f"{root}/translation/{file_name}".strip('/')
 
-def translate_file(bucket, object_key):
-    print(f"start translating of {object_key}")
+def get_checkpoint_prefix_from_objectkey(object_key):
+    paths = object_key.split('/')
+    root = '/'.join(paths[:-1])
+    file_name = paths[-1]
+    return f"{root}/translation/_checkpoint/{file_name}/".lstrip('/')
+
+class TranslationCheckpoint():
+    # finished segments of one source file, appended to S3 as jsonl part files so that a restarted run skips them
+    bucket: str
+    prefix: str
+
+    def __init__(self, bucket: str, prefix: str, flush_segments: int = 200, flush_seconds: float = 60):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.flush_segments = flush_segments
+        self.flush_seconds = flush_seconds
+        self.done = {}
+        self.buffer = []
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
 
-    file_content = load_content_json_from_s3(bucket, object_key)
-    json_obj_with_translation = translate_by_llm(file_content, model_id)
+    @staticmethod
+    def build_key(normalized_content, src_lang, dest_lang, model_id):
+        # a run with another model or language pair does not pick up the old parts
+        return hashlib.sha1(json.dumps([normalized_content, src_lang, dest_lang, model_id], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def load(self):
+        part_count = 0
+        for summary in s3.Bucket(self.bucket).objects.filter(Prefix=self.prefix):
+            if not summary.key.endswith('.jsonl') or summary.key.endswith('failed.jsonl'):
+                continue
+            part_count += 1
+            body = s3.Object(self.bucket, summary.key).get()['Body'].read().decode('utf-8')
+            for line in body.splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    self.done[record['key']] = record['translation']
+        print(f"loaded {len(self.done)} finished segments from {part_count} checkpoint parts under s3://{self.bucket}/{self.prefix}")
+        return self
+
+    def get(self, key):
+        return self.done.get(key)
+
+    def add(self, key, translation):
+        # only the loaded translations are kept, added ones are looked up by the next run, so a streamed file does not pile up in memory
+        with self.lock:
+            self.buffer.append((key, translation))
+            due = len(self.buffer) >= self.flush_segments or time.time() - self.last_flush >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            keys, self.buffer = self.buffer, []
+            self.last_flush = time.time()
+            lines = [ json.dumps({'key': key, 'translation': translation}, ensure_ascii=False) + "\n" for key, translation in keys ]
+        if not lines:
+            return
+        # parts are never rewritten, a unique name keeps runs racing on the same file from overwriting each other
+        part_key = f"{self.prefix}part-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.jsonl"
+        s3.Bucket(self.bucket).put_object(Key=part_key, Body="".join(lines).encode('utf-8'))
+
+    def finish(self, failed_segments):
+        # failed_segments is [(index in src_content or id of the jsonl line, segment)], kept next to the parts until a later run translates them
+        self.flush()
+        failed_key = f"{self.prefix}failed.jsonl"
+        if failed_segments:
+            body = "".join([ json.dumps({'index': idx, 'segment': content}, ensure_ascii=False) + "\n" for idx, content in failed_segments ])
+            s3.Bucket(self.bucket).put_object(Key=failed_key, Body=body.encode('utf-8'))
+            print(f"{len(failed_segments)} segments failed, listed in s3://{self.bucket}/{failed_key}, run the file again to retry only them")
+        else:
+            s3.Bucket(self.bucket).objects.filter(Prefix=self.prefix).delete()
+
+def download_source_file(bucket, object_key):
+    metrics = TranslateMetrics(object_key)
+    if object_key.endswith('.jsonl'):
+        # streamed by translate_jsonl_file
+        return metrics, None
+    with metrics.timer('load_content_json_from_s3'):
+        file_content = load_content_json_from_s3(bucket, object_key)
+    return metrics, file_content
+
+def upload_translation(bucket, object_key, json_obj_with_translation, metrics, checkpoint=None):
     text_with_translation = json.dumps(json_obj_with_translation, ensure_ascii=False)
 
     output_key = get_output_path_from_objectkey(object_key)
 
-    print(f"text_with_translation: {text_with_translation}")
     print(f"output_key: {output_key}")
 
     bucket = s3.Bucket(bucket)
 
-    bucket.put_object(Key=output_key, Body=text_with_translation.encode('utf-8'))
+    with metrics.timer('put_object'):
+        bucket.put_object(Key=output_key, Body=text_with_translation.encode('utf-8'))
+
+    if checkpoint:
+        # the parts are removed once every segment is translated
+        checkpoint.finish([ (idx, content) for idx, (content, result) in enumerate(zip(json_obj_with_translation['src_content'], json_obj_with_translation['dest_content'])) if result is None ])
 
+    metrics.record('translate_file', time.perf_counter() - metrics.started)
+    metric_summaries.append(metrics.emit())
     print(f"finish translation of {object_key}")
 
+def read_s3_lines(bucket, object_key):
+    body = s3.Object(bucket, object_key).get()['Body']
+    for line in body.iter_lines():
+        yield line.decode('utf-8', errors='ignore')
+
+def iter_jsonl_chunks(bucket, object_key, chunk_segments):
+    chunk = []
+    for line in read_s3_lines(bucket, object_key):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        record.setdefault('src_lang', DEFAULT_SRC_LANG)
+        record.setdefault('dest_lang', DEFAULT_DEST_LANG)
+        chunk.append(record)
+        if len(chunk) >= chunk_segments:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class S3MultipartWriter():
+    # collects the written text into parts of at least part_bytes and uploads them as one multipart upload
+    part_bytes: int
+
+    def __init__(self, bucket: str, key: str, part_bytes: int = STREAM_PART_BYTES):
+        self.part_bytes = part_bytes
+        self.upload = s3.Object(bucket, key).initiate_multipart_upload()
+        self.parts = []
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.buffer.append(data)
+        self.buffered_bytes += len(data)
+        if self.buffered_bytes >= self.part_bytes:
+            self.upload_part()
+
+    def upload_part(self):
+        part_number = len(self.parts) + 1
+        response = self.upload.Part(part_number).upload(Body=b''.join(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def close(self):
+        # an empty output is still uploaded as one empty part
+        if self.buffer or not self.parts:
+            self.upload_part()
+        self.upload.complete(MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        self.upload.abort()
+
+def translate_jsonl_file(bucket, object_key, metrics, checkpoint=None):
+    # reads, translates and uploads stream_chunk_segments lines at a time, the memory does not grow with the file
+    output_key = get_output_path_from_objectkey(object_key)
+    print(f"output_key: {output_key}")
+    writer = S3MultipartWriter(bucket, output_key)
+    failed_segments = []
+    line_count = 0
+    try:
+        for chunk in iter_jsonl_chunks(bucket, object_key, STREAM_CHUNK_SEGMENTS):
+            # lines of the chunk are translated per language pair and written back in their order
+            positions_by_lang = defaultdict(list)
+            for pos, record in enumerate(chunk):
+                positions_by_lang[(record['src_lang'], record['dest_lang'])].append(pos)
+            results = [None] * len(chunk)
+            for (src_lang, dest_lang), positions in positions_by_lang.items():
+                dest_content = translate_segments([ chunk[pos]['src_content'] for pos in positions ], src_lang, dest_lang, model_id,
+                                                  metrics=metrics, checkpoint=checkpoint)
+                for pos, result in zip(positions, dest_content):
+                    results[pos] = result
+
+            for pos, (record, result) in enumerate(zip(chunk, results)):
+                record['dest_content'] = result
+                if result is None:
+                    failed_segments.append((record.get('id', line_count + pos), record['src_content']))
+                writer.write(json.dumps(record, ensure_ascii=False) + "\n")
+            line_count += len(chunk)
+        with metrics.timer('put_object'):
+            writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+    if checkpoint:
+        checkpoint.finish(failed_segments)
+    if translation_memory:
+        translation_memory.report()
+
+    metrics.record('translate_file', time.perf_counter() - metrics.started)
+    metric_summaries.append(metrics.emit())
+    print(f"finish translation of {object_key}, {line_count} lines")
+
+def translate_file(bucket, object_key, downloaded=None, upload_executor=None):
+    # downloaded is a future of download_source_file started ahead of time,
+    # with an upload_executor the upload runs in the background and its future is returned
+    print(f"start translating of {object_key}")
+
+    checkpoint = None
+    if CHECKPOINT_ENABLED:
+        checkpoint = TranslationCheckpoint(bucket, get_checkpoint_prefix_from_objectkey(object_key), CHECKPOINT_SEGMENTS, CHECKPOINT_SECONDS).load()
+    metrics, file_content = downloaded.result() if downloaded else download_source_file(bucket, object_key)
+    if object_key.endswith('.jsonl'):
+        # uploaded part by part while translating, there is nothing left to upload in the background
+        translate_jsonl_file(bucket, object_key, metrics, checkpoint)
+        return None
+    json_obj_with_translation = translate_by_llm(file_content, model_id, metrics=metrics, checkpoint=checkpoint)
+
+    if upload_executor:
+        return upload_executor.submit(upload_translation, bucket, object_key, json_obj_with_translation, metrics, checkpoint)
+    upload_translation(bucket, object_key, json_obj_with_translation, metrics, checkpoint)
+
+def translate_files(bucket, object_keys, max_files_in_flight=MAX_FILES_IN_FLIGHT):
+    # up to max_files_in_flight files are translated at once, as many are downloaded ahead and uploads run behind,
+    # a failed file does not stop the others, the failed keys are returned
+    pending_keys = deque(object_keys)
+    downloads = deque()
+    running = {}
+    uploads = {}
+    failed_keys = []
+
+    def prefetch():
+        while pending_keys and len(downloads) < max_files_in_flight:
+            key = pending_keys.popleft()
+            downloads.append((key, download_executor.submit(download_source_file, bucket, key)))
+
+    with ThreadPoolExecutor(max_workers=max_files_in_flight) as download_executor, \
+         ThreadPoolExecutor(max_workers=max_files_in_flight) as file_executor, \
+         ThreadPoolExecutor(max_workers=max_files_in_flight) as upload_executor:
+        prefetch()
+        while downloads or running:
+            while downloads and len(running) < max_files_in_flight:
+                key, downloaded = downloads.popleft()
+                running[file_executor.submit(translate_file, bucket, key, downloaded, upload_executor)] = key
+                prefetch()
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                try:
+                    upload = future.result()
+                    if upload is not None:
+                        uploads[upload] = key
+                except Exception as e:
+                    print(f"failed to translate {key}, Exception: {str(e)}")
+                    failed_keys.append(key)
+
+        for future, key in uploads.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"failed to upload translation of {key}, Exception: {str(e)}")
+                failed_keys.append(key)
+
+    return failed_keys
+
+class BatchInferenceWriter():
+    # phase one of batch mode, collects the bedrock calls of all files as batch inference records.
+    # <prefix>/<run_id>/input/records-N.jsonl holds {"recordId", "modelInput"} lines and is written as soon as it is full,
+    # files/N.json keeps one partly translated file with the records that fill it, manifest.jsonl lists the files/ objects
+    def __init__(self, bucket, prefix, run_id, records_per_file=50000):
+        self.bucket = bucket
+        self.run_prefix = f"{prefix}/{run_id}"
+        self.records_per_file = records_per_file
+        self.records = []
+        self.record_count = 0
+        self.manifest = []
+        self.lock = threading.Lock()
+
+    def get_record_file(self, record_number):
+        return f"records-{record_number // self.records_per_file:05d}.jsonl"
+
+    def flush_records(self):
+        if not self.records:
+            return
+        body = "".join([ json.dumps(record, ensure_ascii=False) + "\n" for record in self.records ])
+        s3.Bucket(self.bucket).put_object(Key=f"{self.run_prefix}/input/{self.get_record_file(self.record_count - 1)}", Body=body.encode('utf-8'))
+        self.records = []
+
+    def add_file(self, object_key, json_obj, batch_requests):
+        with self.lock:
+            file_records = []
+            for request in batch_requests:
+                # 11 character ids like the examples of the bedrock documentation
+                record_id = f"R{self.record_count:010d}"
+                file_records.append({'record': record_id, 'input': self.get_record_file(self.record_count), 'segments': request['segments']})
+                self.records.append({'recordId': record_id, 'modelInput': request['model_input']})
+                self.record_count += 1
+                if len(self.records) >= self.records_per_file:
+                    self.flush_records()
+            partial_key = f"{self.run_prefix}/files/{len(self.manifest):06d}.json"
+            self.manifest.append({'file': object_key, 'partial': partial_key})
+        body = json.dumps({'file': object_key, 'json_obj': json_obj, 'records': file_records}, ensure_ascii=False)
+        s3.Bucket(self.bucket).put_object(Key=partial_key, Body=body.encode('utf-8'))
+
+    def close(self):
+        with self.lock:
+            self.flush_records()
+        body = "".join([ json.dumps(line, ensure_ascii=False) + "\n" for line in self.manifest ])
+        s3.Bucket(self.bucket).put_object(Key=f"{self.run_prefix}/manifest.jsonl", Body=body.encode('utf-8'))
+        print(f"wrote {self.record_count} batch records of {len(self.manifest)} files to s3://{self.bucket}/{self.run_prefix}/input/")
+
+class BatchRecordCache():
+    # the records of a few input files with their batch output, the records of one source file are consecutive
+    # so files assembled in manifest order only ever need the last couple of input files
+    def __init__(self, bucket, input_prefix, output_keys, max_files=2):
+        self.bucket = bucket
+        self.input_prefix = input_prefix
+        self.output_keys = output_keys
+        self.max_files = max_files
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def load(self, record_file):
+        model_inputs = { record['recordId']: record['modelInput'] for record in iter_s3_jsonl(self.bucket, f"{self.input_prefix}{record_file}") }
+        outputs = {}
+        if record_file in self.output_keys:
+            outputs = { record['recordId']: record for record in iter_s3_jsonl(self.bucket, self.output_keys[record_file]) }
+        print(f"{record_file}: {len(outputs)} of {len(model_inputs)} batch records have an output")
+        return model_inputs, outputs
+
+    def get(self, record_file):
+        # (model inputs, outputs) by record id, the least recently used input file is dropped
+        with self.lock:
+            if record_file not in self.files:
+                self.files[record_file] = self.load(record_file)
+                while len(self.files) > self.max_files:
+                    del self.files[next(iter(self.files))]
+            else:
+                self.files[record_file] = self.files.pop(record_file)
+            return self.files[record_file]
+
+def iter_s3_jsonl(bucket, object_key):
+    for line in read_s3_lines(bucket, object_key):
+        if line.strip():
+            yield json.loads(line)
+
+def prepare_batch_inference(bucket, object_keys, run_id):
+    streamed_keys = [ key for key in object_keys if key.endswith('.jsonl') ]
+    if streamed_keys:
+        print(f"skipping {len(streamed_keys)} .jsonl sources, they are only translated without --batch_phase: {streamed_keys}")
+        object_keys = [ key for key in object_keys if not key.endswith('.jsonl') ]
+    writer = BatchInferenceWriter(bucket, BATCH_PREFIX, run_id, BATCH_RECORDS_PER_FILE)
+
+    def prepare_file(key):
+        # returns the key if the file failed, it is left out of the run and the others go on
+        try:
+            metrics, file_content = download_source_file(bucket, key)
+            batch_requests = []
+            json_obj = translate_by_llm(file_content, model_id, metrics=metrics, batch_requests=batch_requests)
+            writer.add_file(key, json_obj, batch_requests)
+            metric_summaries.append(metrics.emit())
+        except Exception as e:
+            print(f"failed to prepare {key}, Exception: {str(e)}")
+            return key
+        return None
+
+    with ThreadPoolExecutor(max_workers=MAX_FILES_IN_FLIGHT) as executor:
+        failed_keys = [ key for key in executor.map(prepare_file, object_keys) if key is not None ]
+    writer.close()
+
+    if writer.record_count < 100:
+        # below the minimum record count of a batch inference job, use the synchronous mode for small runs
+        print(f"only {writer.record_count} records, a batch inference job may reject fewer than 100")
+    if BATCH_ROLE_ARN:
+        response = boto3.client('bedrock', region_name=REGION).create_model_invocation_job(
+            jobName=f"translate-{run_id}",
+            roleArn=BATCH_ROLE_ARN,
+            modelId=model_id,
+            inputDataConfig={'s3InputDataConfig': {'s3Uri': f"s3://{bucket}/{writer.run_prefix}/input/"}},
+            outputDataConfig={'s3OutputDataConfig': {'s3Uri': f"s3://{bucket}/{writer.run_prefix}/output/"}})
+        print(f"started batch inference job {response['jobArn']}")
+    print(f"run the assemble phase with --batch_run_id {run_id} once the batch output is written")
+    return failed_keys
+
+def parse_batch_output(record, packed):
+    # None for records the batch job failed on, a list of results per segment otherwise
+    if 'modelOutput' not in record:
+        print(f"batch record {record.get('recordId')} failed: {record.get('error')}")
+        return None
+    content = record['modelOutput'].get('content') or [{}]
+    text = content[0].get('text')
+    if text is None:
+        print(f"batch record {record.get('recordId')} has no text output")
+        return None
+    return parse_packed_translation(text, packed) if packed > 1 else [text]
+
+def assemble_batch_translations(bucket, run_id):
+    # phase two of batch mode, fills dest_content of every file of the run from the batch output and writes translation/,
+    # only the files in flight and the input files their records are in are held in memory
+    run_prefix = f"{BATCH_PREFIX}/{run_id}"
+    output_prefix = BATCH_OUTPUT_PREFIX or f"{run_prefix}/output/"
+    manifest = list(iter_s3_jsonl(bucket, f"{run_prefix}/manifest.jsonl"))
+    # bedrock writes <input file>.out below a folder of the job
+    output_keys = { summary.key.rsplit('/', 1)[-1][:-len('.out')]: summary.key
+                    for summary in s3.Bucket(bucket).objects.filter(Prefix=output_prefix) if summary.key.endswith('.jsonl.out') }
+    record_cache = BatchRecordCache(bucket, f"{run_prefix}/input/", output_keys, max_files=MAX_FILES_IN_FLIGHT + 1)
+
+    def assemble_file(line):
+        # returns the key if the file failed, like translate_files a failed file does not stop the others
+        key = line['file']
+        try:
+            assemble_translation(line)
+        except Exception as e:
+            print(f"failed to assemble {key}, Exception: {str(e)}")
+            return key
+        return None
+
+    def assemble_translation(line):
+        key = line['file']
+        metrics = TranslateMetrics(key)
+        partial = json.loads(s3.Object(bucket, line['partial']).get()['Body'].read().decode('utf-8'))
+        json_obj = partial['json_obj']
+        for record in partial['records']:
+            model_inputs, outputs = record_cache.get(record['input'])
+            segments = record['segments']
+            results = parse_batch_output(outputs[record['record']], len(segments)) if record['record'] in outputs else None
+            if results is None:
+                metrics.incr('batch_failed_records')
+                results = [None] * len(segments)
+            missing = results.count(None)
+            if missing and BATCH_FALLBACK:
+                # the same call on demand, a packed call is parsed the same way as in the batch
+                metrics.incr('batch_fallback_records')
+                model_input = model_inputs[record['record']]
+                text = invoke_bedrock(model_id, model_input['messages'][0]['content'], model_input['max_tokens'], model_input['messages'][1]['content'],
+                                      model_input['stop_sequences'], metrics=metrics, system=''.join(block['text'] for block in model_input.get('system', [])))
+                fallback_results = parse_packed_translation(text, len(segments)) if len(segments) > 1 else [text]
+                results = [ result if result is not None else fallback for result, fallback in zip(results, fallback_results) ]
+            for segment, result in zip(segments, results):
+                if result is None:
+                    continue
+                for pos in segment['positions']:
+                    json_obj['dest_content'][pos] = result
+                if translation_memory and segment['tm_key']:
+                    translation_memory.put(segment['tm_key'], result)
+        metrics.incr('untranslated_segments', json_obj['dest_content'].count(None))
+        upload_translation(bucket, key, json_obj, metrics)
+
+    with ThreadPoolExecutor(max_workers=MAX_FILES_IN_FLIGHT) as executor:
+        return [ key for key in executor.map(assemble_file, manifest) if key is not None ]
+
 if __name__ == '__main__':
+    if TRANSLATION_MEMORY_ENABLED:
+        translation_memory = TranslationMemory.from_s3(bucket, TM_S3_KEY, TM_LOCAL_PATH, TM_MAX_BYTES)
+
+    s3_keys = []
     for s3_key in object_key.split(','):
         s3_key = urllib.parse.unquote(s3_key) ##In case Chinese filename
         s3_key = s3_key.replace('+',' ') ##replace the '+' with space. ps:if the original file name contains space, then s3 notification will replace it with '+'.
-        translate_file(bucket, s3_key)
\ No newline at end of file
+        s3_keys.append(s3_key)
+
+    failed_keys = []
+    if BATCH_PHASE == 'prepare':
+        failed_keys = prepare_batch_inference(bucket, s3_keys, BATCH_RUN_ID or datetime.now().strftime('%Y%m%d-%H%M%S'))
+    elif BATCH_PHASE == 'assemble':
+        if not BATCH_RUN_ID:
+            raise RuntimeError("--batch_run_id of the prepare phase is required to assemble")
+        failed_keys = assemble_batch_translations(bucket, BATCH_RUN_ID)
+    else:
+        failed_keys = translate_files(bucket, s3_keys)
+
+    if translation_memory:
+        translation_memory.sync_to_s3(bucket, TM_S3_KEY)
+
+    bedrock_limiter.report()
+    upload_metric_summaries(bucket, METRICS_S3_PREFIX, metric_summaries)
+
+    if failed_keys:
+        # fail the run so that batch_upload_docs retries it, the checkpoints keep the finished segments
+        raise RuntimeError(f"{len(failed_keys)} of {len(s3_keys)} files failed: {failed_keys}")
\ No newline at end of file
@@ -1,6 +1,8 @@
 import * as glue from  '@aws-cdk/aws-glue-alpha';
-import { NestedStack,Duration, CfnOutput }  from 'aws-cdk-lib';
+import { NestedStack,Duration, CfnOutput, RemovalPolicy }  from 'aws-cdk-lib';
 import * as iam from "aws-cdk-lib/aws-iam";
+import * as s3 from 'aws-cdk-lib/aws-s3';
+import * as s3deploy from 'aws-cdk-lib/aws-s3-deployment';
 import * as dotenv from "dotenv";
 dotenv.config();
 import path from "path";
@@ -9,6 +11,10 @@ import { fileURLToPath } from "url";
 const __filename = fileURLToPath(import.meta.url);
 const __dirname = path.dirname(__filename);
 
+// modules imported by both jobs, glue imports an extra python file by its s3 file name
+const SHARED_MODULES = ['job_args.py', 'embedders.py', 'glossary_snapshot.py'];
+const SHARED_MODULES_PREFIX = 'glue/shared_modules';
+
 export class GlueStack extends NestedStack {
 
     jobArn = '';
@@ -31,12 +37,27 @@ export class GlueStack extends NestedStack {
         subnet:props.subnets[0],
       });
 
+      // Code.fromAsset would publish every module as <asset hash>.py, so they are copied to fixed keys instead
+      const sharedModulesBucket = new s3.Bucket(this, 'GlueSharedModulesBucket', {
+        removalPolicy: RemovalPolicy.DESTROY,
+        autoDeleteObjects: true,
+      });
+      const sharedModules = new s3deploy.BucketDeployment(this, 'GlueSharedModules', {
+        sources: [s3deploy.Source.asset(path.join(__dirname, '../../code/offline_process'), {
+          exclude: ['*', ...SHARED_MODULES.map(module => `!${module}`)],
+        })],
+        destinationBucket: sharedModulesBucket,
+        destinationKeyPrefix: SHARED_MODULES_PREFIX,
+      });
+      const sharedModuleFiles = () => SHARED_MODULES.map(module => glue.Code.fromBucket(sharedModulesBucket, `${SHARED_MODULES_PREFIX}/${module}`));
+
 
       const ingest_job = new glue.Job(this, 'ingest-knowledge-from-s3',{
             executable: glue.JobExecutable.pythonShell({
             glueVersion: glue.GlueVersion.V1_0,
             pythonVersion: glue.PythonVersion.THREE_NINE,
             script: glue.Code.fromAsset(path.join(__dirname, '../../code/offline_process/aos_write_job.py')),
+            extraPythonFiles: sharedModuleFiles(),
           }),
           jobName:'ingest_knowledge',
           maxConcurrentRuns:100,
@@ -52,6 +73,7 @@ export class GlueStack extends NestedStack {
               '--object_key': 'kb/crosslingual_terminology.json,kb/multilingual_terminology.json'
           }
       })
+      ingest_job.node.addDependency(sharedModules);
       ingest_job.role.addToPrincipalPolicy(
         new iam.PolicyStatement({
               actions: [ 
@@ -60,6 +82,7 @@ export class GlueStack extends NestedStack {
                 "s3:List*",
                 "s3:Put*",
                 "s3:Get*",
+                "s3:DeleteObject",
                 "es:*",
                 "bedrock:*",
                 ],
@@ -68,11 +91,28 @@ export class GlueStack extends NestedStack {
               })
       )
 
+      // bedrock batch inference reads the records and writes the output of --batch_phase prepare with this role
+      const batch_inference_role = new iam.Role(this, 'batch-inference-role', {
+        assumedBy: new iam.ServicePrincipal('bedrock.amazonaws.com'),
+      });
+      batch_inference_role.addToPolicy(
+        new iam.PolicyStatement({
+              actions: [
+                "s3:List*",
+                "s3:Get*",
+                "s3:Put*",
+                ],
+              effect: iam.Effect.ALLOW,
+              resources: ['*'],
+              })
+      )
+
       const rag_job = new glue.Job(this, 'rag-process',{
             executable: glue.JobExecutable.pythonShell({
             glueVersion: glue.GlueVersion.V1_0,
             pythonVersion: glue.PythonVersion.THREE_NINE,
             script: glue.Code.fromAsset(path.join(__dirname, '../../code/offline_process/rag_based_translate.py')),
+            extraPythonFiles: sharedModuleFiles(),
           }),
           jobName:'rag_based_translate',
           maxConcurrentRuns:100,
@@ -87,8 +127,12 @@ export class GlueStack extends NestedStack {
               '--model_id': 'anthropic.claude-3-sonnet-20240229-v1:0',
               '--object_key': 'src_files/chat_text.json',
               '--bucket': '687752207838-24-04-10-02-26-15-aos-rag-bucket',
+              '--max_workers': '4',
+              '--checkpoint': 'true',
+              '--batch_role_arn': batch_inference_role.roleArn,
           }
       })
+      rag_job.node.addDependency(sharedModules);
       rag_job.role.addToPrincipalPolicy(
         new iam.PolicyStatement({
               actions: [ 
@@ -97,6 +141,7 @@ export class GlueStack extends NestedStack {
                 "s3:List*",
                 "s3:Put*",
                 "s3:Get*",
+                "s3:DeleteObject",
                 "es:*",
                 "bedrock:*",
                 ],
@@ -104,6 +149,15 @@ export class GlueStack extends NestedStack {
               resources: ['*'],
               })
       )
+      // create_model_invocation_job hands the batch role to bedrock
+      rag_job.role.addToPrincipalPolicy(
+        new iam.PolicyStatement({
+              actions: [ "iam:PassRole" ],
+              effect: iam.Effect.ALLOW,
+              resources: [ batch_inference_role.roleArn ],
+              conditions: { StringEquals: { 'iam:PassedToService': 'bedrock.amazonaws.com' } },
+              })
+      )
       this.jobArn = ingest_job.jobArn;
       this.jobName = ingest_job.jobName;
       this.ragJobName = rag_job.jobName
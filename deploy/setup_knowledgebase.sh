@@ -13,6 +13,18 @@ payload1="{
         }
     },
     \"mappings\": {
+        \"dynamic_templates\": [
+            {
+                \"term_per_language\": {
+                    \"match\": \"term_*\",
+                    \"mapping\": {
+                        \"type\": \"text\",
+                        \"analyzer\": \"ik_max_word\",
+                        \"search_analyzer\": \"ik_smart\"
+                    }
+                }
+            }
+        ],
         \"properties\": {
             \"publish_date\" : {
                 \"type\": \"date\",
@@ -34,9 +46,22 @@ payload1="{
                 \"analyzer\": \"ik_max_word\",
                 \"search_analyzer\": \"ik_smart\"
             },
+            \"terms\": {
+                \"type\": \"text\",
+                \"analyzer\": \"ik_max_word\",
+                \"search_analyzer\": \"ik_smart\",
+                \"fields\": {
+                    \"keyword\": {
+                        \"type\": \"keyword\"
+                    }
+                }
+            },
             \"doc_title\": {
                 \"type\": \"keyword\"
             },
+            \"doc_key\": {
+                \"type\": \"keyword\"
+            },
             \"doc_author\": {
                 \"type\": \"keyword\"
             },
@@ -49,6 +74,9 @@ payload1="{
             \"doc_classify\": {
                 \"type\": \"keyword\"
             },
+            \"langs\": {
+                \"type\": \"keyword\"
+            },
             \"embedding\": {
                 \"type\": \"knn_vector\",
                 \"dimension\": ${DIMENSION},
@@ -67,9 +95,23 @@ payload1="{
 }"
 
 # 创建chatbot-index索引
+# the data lives in a versioned index behind the alias rag-data-index, the translate job only queries the alias
+# and aos_write_job.py --rebuild true reloads into a new version and swaps the alias without downtime
 #echo $payload1 
-echo "delete existed index[rag-data-index] of opensearch."
-curl -XDELETE "$OPENSEARCH_ENDPOINT/rag-data-index" -H "Content-Type: application/json"
+ALIAS="rag-data-index"
+INDEX="${ALIAS}-$(date +%Y%m%d%H%M%S)"
+echo "create new index[${INDEX}] of opensearch"
+curl -XPUT "$OPENSEARCH_ENDPOINT/${INDEX}" -H "Content-Type: application/json" -d "$payload1"
 echo 
-echo "create new index[rag-data-index] of opensearch"
-curl -XPUT "$OPENSEARCH_ENDPOINT/rag-data-index" -H "Content-Type: application/json" -d "$payload1"
\ No newline at end of file
+
+# indices currently behind the alias, and a plain index of the same name created by earlier versions of this script
+old_indices=$(curl -s "$OPENSEARCH_ENDPOINT/_alias/${ALIAS}" | grep -o "\"${ALIAS}-[0-9]*\"" | tr -d '"')
+actions="{\"add\": {\"index\": \"${INDEX}\", \"alias\": \"${ALIAS}\"}}"
+for old_index in $old_indices; do
+    actions="${actions}, {\"remove_index\": {\"index\": \"${old_index}\"}}"
+done
+if [ -z "$old_indices" ] && [ "$(curl -s -o /dev/null -w "%{http_code}" "$OPENSEARCH_ENDPOINT/${ALIAS}")" = "200" ]; then
+    actions="${actions}, {\"remove_index\": {\"index\": \"${ALIAS}\"}}"
+fi
+echo "point alias[${ALIAS}] to ${INDEX}, delete ${old_indices:-${ALIAS}}"
+curl -XPOST "$OPENSEARCH_ENDPOINT/_aliases" -H "Content-Type: application/json" -d "{\"actions\": [${actions}]}"